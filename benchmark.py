@@ -0,0 +1,686 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the whole pipeline on synthetic data: deb2fsexpect.py --batch, merge_expectations.py, and
+check_expect.py, each run as a separate process, at one or more scales.
+
+For each scale, it generates .debs with that many files in total (plus directories), and a root tree
+in which all of them are "installed", with some drift injected. It records the wall-clock time, CPU
+time, peak RSS and throughput of each step, and the step's own --stats-json, in a results file that
+can be compared against another one: ./benchmark.py compare OLD.json NEW.json
+
+Everything happens below --workdir, offline and without root privileges. With an explicit --workdir,
+the generated data is kept and reused by later runs with the same generator settings.
+"""
+
+import argparse
+import expectation_io
+import expectation_record
+import gzip
+import instrumentation
+import io
+import json
+import lzma
+import os
+import platform
+import random
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import tracemalloc
+
+
+RESULTS_FORMAT_VERSION = 1
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# Arbitrary, but fixed, so that the trees of different runs are identical.
+MTIME = 1700000000
+FILES_PER_DIR = 100
+DEFAULT_SCALES = ["10k", "100k"]
+DEFAULT_SIZES = "0:5,256:35,2k:40,16k:19,256k:1"
+XATTR_NAME = "user.sysexpect_benchmark"
+# How a file in the tree can differ from its expectation, depending on its filetype.
+DRIFT_KINDS = {
+    "reg": ["content", "size", "mode", "mtime", "missing", "extraneous"],
+    "sym": ["linkname", "missing"],
+    "lnk": ["hardlink", "missing"],
+}
+# Changing any of these changes the generated data.
+GENERATOR_SETTINGS = [
+    "files_per_deb",
+    "sizes",
+    "hardlink_fraction",
+    "symlink_fraction",
+    "xattr_fraction",
+    "drift_fraction",
+    "compression",
+    "seed",
+]
+SUFFIXES = {"k": 1, "m": 2, "g": 3}
+# Runs a step in a fresh, small process, and writes its resource usage to the file in argv[1].
+# Measuring from here would be misleading: On Linux, the peak RSS of a child process includes
+# the memory it had before exec, which is the memory of this (rather large) process.
+STEP_WRAPPER = """
+import json, resource, subprocess, sys, time
+started = time.monotonic()
+exit_code = subprocess.call(sys.argv[2:])
+wall_seconds = time.monotonic() - started
+usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+with open(sys.argv[1], "w") as fp:
+    json.dump(
+        {
+            "wall_seconds": wall_seconds,
+            "user_seconds": usage.ru_utime,
+            "system_seconds": usage.ru_stime,
+            "max_rss_kib": usage.ru_maxrss,
+            "exit_code": exit_code,
+        },
+        fp,
+    )
+"""
+
+
+def parse_suffixed(text, base):
+    """
+    Parses e.g. '10k' or '5M', where each suffix multiplies by 'base' (1000 for counts, 1024 for sizes).
+    """
+    text = text.strip()
+    exponent = SUFFIXES.get(text[-1:].lower())
+    if exponent is None:
+        return int(text)
+    return int(float(text[:-1]) * base**exponent)
+
+
+def parse_count(text):
+    try:
+        value = parse_suffixed(text, 1000)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a number: {text!r}")
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1: {text!r}")
+    return value
+
+
+def parse_sizes(text):
+    """
+    Parses a size distribution like '0:5,4k:90,1M:5' into a list of (size, weight).
+    """
+    distribution = []
+    try:
+        for entry in text.split(","):
+            size, weight = entry.split(":")
+            distribution.append((parse_suffixed(size, 1024), float(weight)))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected SIZE:WEIGHT,SIZE:WEIGHT,..., got {text!r}")
+    if not any(weight > 0 for _size, weight in distribution):
+        raise argparse.ArgumentTypeError(f"need at least one positive weight, got {text!r}")
+    return distribution
+
+
+def mean_size(distribution):
+    total_weight = sum(weight for _size, weight in distribution)
+    return sum(size * weight for size, weight in distribution) / total_weight
+
+
+def sample_size(rng, distribution):
+    size = rng.choices([size for size, _weight in distribution], [weight for _size, weight in distribution])[0]
+    # Spread the sizes a bit, so that not all files of a bucket are equally large.
+    return rng.randint(size // 2, size * 3 // 2) if size else 0
+
+
+def plan_package(rng, package, file_count, args):
+    """
+    Returns the directories and the entries of a package. Each entry is a tuple of
+    (name, filetype, mode, size or linkname), with names relative to the root.
+    """
+    dirs = ["usr", "usr/bin", "usr/lib", f"usr/lib/{package}", "usr/share", "usr/share/doc", f"usr/share/doc/{package}"]
+    entries = []
+    regular_names = []
+    for index in range(file_count):
+        if index == 0:
+            entries.append((f"usr/share/doc/{package}/copyright", "reg", 0o644, sample_size(rng, args.sizes)))
+            continue
+        if index == 1:
+            # A directory shared by all packages, which therefore gets large.
+            entries.append((f"usr/bin/{package}", "reg", 0o755, sample_size(rng, args.sizes)))
+            continue
+        subdir, position = divmod(index - 2, FILES_PER_DIR)
+        directory = f"usr/lib/{package}/d{subdir:04}"
+        if position == 0:
+            dirs.append(directory)
+        name = f"{directory}/f{position:03}"
+        choice = rng.random()
+        if choice < args.hardlink_fraction and regular_names:
+            entries.append((name, "lnk", 0o644, rng.choice(regular_names)))
+        elif choice < args.hardlink_fraction + args.symlink_fraction and position > 0:
+            entries.append((name, "sym", 0o777, f"f{rng.randrange(position):03}"))
+        else:
+            entries.append((name, "reg", 0o644, sample_size(rng, args.sizes)))
+            regular_names.append(name)
+    return dirs, entries
+
+
+def tar_info(name, type, mode):
+    info = tarfile.TarInfo("./" + name if name else ".")
+    info.type = type
+    info.mode = mode
+    info.mtime = MTIME
+    # Match the owner of the generated tree, so that only the injected drift is reported.
+    info.uid = os.getuid()
+    info.gid = os.getgid()
+    return info
+
+
+def write_tar(fp, members, compression):
+    """
+    Writes the (TarInfo, content or None) pairs as a tar archive, compressed like in a .deb.
+    """
+    if compression == "gz":
+        compressed_fp = gzip.GzipFile(fileobj=fp, mode="wb", compresslevel=1, mtime=MTIME)
+    elif compression == "xz":
+        compressed_fp = lzma.LZMAFile(fp, mode="wb", preset=1)
+    else:
+        compressed_fp = None
+    # Neither of these closes the underlying fp.
+    with tarfile.open(fileobj=compressed_fp or fp, mode="w", format=tarfile.GNU_FORMAT) as tar:
+        for info, content in members:
+            tar.addfile(info, None if content is None else io.BytesIO(content))
+    if compressed_fp is not None:
+        compressed_fp.close()
+
+
+def write_ar_member(fp, name, data):
+    # Name, mtime, uid, gid, mode, size, magic; members are padded to an even size.
+    fp.write(f"{name:<16}{MTIME:<12}{0:<6}{0:<6}{0o100644:<8o}{len(data):<10}`\n".encode())
+    fp.write(data)
+    if len(data) % 2:
+        fp.write(b"\n")
+
+
+def write_deb(filename, package, dirs, entries, contents, compression):
+    control = f"Package: {package}\nVersion: 1.0\nArchitecture: all\nMaintainer: Benchmark <benchmark@localhost>\nDescription: Synthetic package for benchmark.py\n"
+    control_info = tar_info("control", tarfile.REGTYPE, 0o644)
+    control_info.size = len(control)
+    control_fp = io.BytesIO()
+    write_tar(control_fp, [(tar_info("", tarfile.DIRTYPE, 0o755), None), (control_info, control.encode())], "gz")
+
+    members = [(tar_info("", tarfile.DIRTYPE, 0o755), None)]
+    members.extend((tar_info(name, tarfile.DIRTYPE, 0o755), None) for name in dirs)
+    for name, filetype, mode, size_or_linkname in entries:
+        if filetype == "reg":
+            info = tar_info(name, tarfile.REGTYPE, mode)
+            info.size = size_or_linkname
+            members.append((info, contents[name]))
+        elif filetype == "lnk":
+            info = tar_info(name, tarfile.LNKTYPE, mode)
+            info.linkname = "./" + size_or_linkname
+            members.append((info, None))
+        else:
+            info = tar_info(name, tarfile.SYMTYPE, mode)
+            info.linkname = size_or_linkname
+            members.append((info, None))
+    data_fp = io.BytesIO()
+    write_tar(data_fp, members, compression)
+
+    data_name = "data.tar" if compression == "none" else f"data.tar.{compression}"
+    with open(filename, "wb") as fp:
+        fp.write(b"!<arch>\n")
+        write_ar_member(fp, "debian-binary", b"2.0\n")
+        write_ar_member(fp, "control.tar.gz", control_fp.getvalue())
+        write_ar_member(fp, data_name, data_fp.getvalue())
+
+
+def populate_tree(root, dirs, entries, contents):
+    for name in dirs:
+        path = os.path.join(root, name)
+        if not os.path.isdir(path):
+            os.mkdir(path)
+            os.chmod(path, 0o755)
+    for name, filetype, mode, size_or_linkname in entries:
+        path = os.path.join(root, name)
+        if filetype == "reg":
+            with open(path, "wb") as fp:
+                fp.write(contents[name])
+            os.chmod(path, mode)
+            os.utime(path, (MTIME, MTIME))
+        elif filetype == "lnk":
+            os.link(os.path.join(root, size_or_linkname), path)
+        else:
+            os.symlink(size_or_linkname, path)
+            os.utime(path, (MTIME, MTIME), follow_symlinks=False)
+
+
+def inject_drift(rng, root, entries, contents, drift_fraction, drift_counts):
+    for name, filetype, mode, size_or_linkname in entries:
+        if rng.random() >= drift_fraction:
+            continue
+        kind = rng.choice(DRIFT_KINDS[filetype])
+        path = os.path.join(root, name)
+        if not os.path.lexists(path):
+            # Already removed, e.g. as the target of a hardlink.
+            continue
+        if kind == "content" and contents[name]:
+            # Same size and mtime, so only hashing can tell.
+            with open(path, "r+b") as fp:
+                fp.write(bytes([contents[name][0] ^ 0xFF]))
+            os.utime(path, (MTIME, MTIME))
+        elif kind in ["content", "size"]:
+            with open(path, "ab") as fp:
+                fp.write(b"\n")
+            os.utime(path, (MTIME, MTIME))
+        elif kind == "mode":
+            os.chmod(path, 0o600)
+        elif kind == "mtime":
+            # Well beyond the tolerance of check_expect.py for mtimes.
+            os.utime(path, (MTIME + 3600, MTIME + 3600))
+        elif kind == "missing":
+            os.remove(path)
+        elif kind == "extraneous":
+            with open(path + ".extraneous", "wb") as fp:
+                fp.write(b"unexpected\n")
+        elif kind == "linkname":
+            os.remove(path)
+            os.symlink(size_or_linkname + ".moved", path)
+            os.utime(path, (MTIME, MTIME), follow_symlinks=False)
+        elif kind == "hardlink":
+            # Same content and metadata, but a separate inode.
+            shutil.copy2(os.path.join(root, size_or_linkname), path + ".tmp")
+            os.replace(path + ".tmp", path)
+        else:
+            raise AssertionError(kind)
+        drift_counts[kind] = drift_counts.get(kind, 0) + 1
+
+
+def set_xattrs(rng, root, entries, xattr_fraction):
+    """
+    Sets an extended attribute on some regular files in the tree, like SELinux labels on a real
+    system. Returns how many, or None if the filesystem doesn't support user xattrs.
+    """
+    count = 0
+    for name, filetype, _mode, _size in entries:
+        if filetype != "reg" or rng.random() >= xattr_fraction:
+            continue
+        try:
+            os.setxattr(os.path.join(root, name), XATTR_NAME, b"benchmark")
+        except OSError as e:
+            print(f"Warning: Can't set xattrs in {root} ({e}), skipping them", file=sys.stderr)
+            return None
+        count += 1
+    return count
+
+
+def generator_config(args, files):
+    config = {setting: getattr(args, setting) for setting in GENERATOR_SETTINGS}
+    config["files"] = files
+    # Round-trip through JSON, so that it compares equal to a stored config (lists instead of tuples).
+    return json.loads(json.dumps(config))
+
+
+def generate(scale_dir, files, args):
+    """
+    Generates the .debs and the tree for one scale, or reuses them if they were generated with the
+    same settings before. Returns information about them.
+    """
+    marker_filename = os.path.join(scale_dir, "generated.json")
+    config = generator_config(args, files)
+    if os.path.exists(marker_filename):
+        with open(marker_filename, "r") as fp:
+            marker = json.load(fp)
+        if marker["config"] == config:
+            print(f"Reusing the data in {scale_dir}", file=sys.stderr)
+            return marker["info"]
+    if os.path.exists(scale_dir):
+        shutil.rmtree(scale_dir)
+    debs_dir = os.path.join(scale_dir, "debs")
+    root = os.path.join(scale_dir, "root")
+    os.makedirs(debs_dir)
+    os.mkdir(root)
+    os.chmod(root, 0o755)
+    package_count = -(-files // args.files_per_deb)
+    estimate = 2 * files * mean_size(args.sizes)
+    print(f"Generating {files} files in {package_count} .debs in {scale_dir}, about {estimate / 2**30:.1f} GiB ...", file=sys.stderr)
+
+    started = time.monotonic()
+    stats = instrumentation.Stats("benchmark")
+    progress = instrumentation.Progress(stats, "debs", lambda: progress.done / package_count)
+    info = {"files": files, "debs": package_count, "bytes": 0, "entries": 0, "xattrs": 0, "drift": dict()}
+    for package_index in range(package_count):
+        package = f"bench{package_index:05}"
+        # Seeded per package, so that each package is the same regardless of the scale.
+        rng = random.Random(f"{args.seed}:{package}")
+        file_count = min(args.files_per_deb, files - package_index * args.files_per_deb)
+        dirs, entries = plan_package(rng, package, file_count, args)
+        contents = {
+            name: rng.randbytes(size_or_linkname)
+            for name, filetype, _mode, size_or_linkname in entries
+            if filetype == "reg"
+        }
+        write_deb(os.path.join(debs_dir, f"{package}_1.0_all.deb"), package, dirs, entries, contents, args.compression)
+        populate_tree(root, dirs, entries, contents)
+        if info["xattrs"] is not None:
+            xattrs = set_xattrs(rng, root, entries, args.xattr_fraction)
+            info["xattrs"] = None if xattrs is None else info["xattrs"] + xattrs
+        inject_drift(rng, root, entries, contents, args.drift_fraction, info["drift"])
+        info["bytes"] += sum(len(content) for content in contents.values())
+        info["entries"] += len(entries) + len(dirs)
+        progress.update()
+    progress.finish()
+    info["generate_seconds"] = time.monotonic() - started
+    with open(marker_filename, "w") as fp:
+        json.dump({"config": config, "info": info}, fp, indent=1)
+    return info
+
+
+def run_step(argv, stdout_filename, stderr_filename, usage_filename):
+    """
+    Runs a script from this directory, and returns its timings and peak RSS (including all of its
+    child processes).
+    """
+    argv = [sys.executable, os.path.join(SCRIPT_DIR, argv[0]), *argv[1:]]
+    with open(stdout_filename, "wb") as stdout_fp, open(stderr_filename, "wb") as stderr_fp:
+        subprocess.run([sys.executable, "-c", STEP_WRAPPER, usage_filename, *argv], stdout=stdout_fp, stderr=stderr_fp)
+    with open(usage_filename, "r") as fp:
+        return json.load(fp)
+
+
+def pipeline_steps(scale_dir, args):
+    """
+    Returns (name, argv) for each step. Each step uses the output of the previous ones.
+    """
+    debs_dir = os.path.join(scale_dir, "debs")
+    json_dir = os.path.join(scale_dir, "expectations")
+    json_filenames = [
+        os.path.join(json_dir, entry + ".json") for entry in sorted(os.listdir(debs_dir)) if entry.endswith(".deb")
+    ]
+    steps = [
+        (
+            "deb2fsexpect",
+            ["deb2fsexpect.py", "--batch", debs_dir, "--output-dir", json_dir, "--no-cache", *shlex.split(args.deb2fsexpect_args)],
+        )
+    ]
+    if len(json_filenames) > 1:
+        total_filename = os.path.join(scale_dir, f"total.{args.format}")
+        steps.append(("merge_expectations", ["merge_expectations.py", *shlex.split(args.merge_args), total_filename, *json_filenames]))
+    else:
+        # merge_expectations.py refuses to "merge" a single source.
+        total_filename = json_filenames[0]
+    steps.append(
+        (
+            "check_expect",
+            ["check_expect.py", "--destdir", os.path.join(scale_dir, "root") + "/", *shlex.split(args.check_args), total_filename],
+        )
+    )
+    return steps
+
+
+def run_scale(scale_dir, info, args):
+    logs_dir = os.path.join(scale_dir, "logs")
+    os.makedirs(logs_dir, exist_ok=True)
+    results = dict()
+    for name, argv in pipeline_steps(scale_dir, args):
+        stats_filename = os.path.join(logs_dir, f"{name}.stats.json")
+        stdout_filename = os.path.join(logs_dir, f"{name}.stdout")
+        stderr_filename = os.path.join(logs_dir, f"{name}.stderr")
+        usage_filename = os.path.join(logs_dir, f"{name}.usage.json")
+        runs = []
+        for _ in range(args.repeat):
+            runs.append(run_step([argv[0], "--stats-json", stats_filename, *argv[1:]], stdout_filename, stderr_filename, usage_filename))
+            if runs[-1]["exit_code"] != 0:
+                break
+        wall_seconds = statistics.median(run["wall_seconds"] for run in runs)
+        result = {
+            "wall_seconds": wall_seconds,
+            "max_rss_kib": max(run["max_rss_kib"] for run in runs),
+            "files_per_second": info["files"] / max(wall_seconds, 1e-6),
+            "mib_per_second": info["bytes"] / 2**20 / max(wall_seconds, 1e-6),
+            "runs": runs,
+        }
+        if os.path.exists(stats_filename):
+            with open(stats_filename, "r") as fp:
+                result["stats"] = json.load(fp)
+        if name == "check_expect":
+            with open(stdout_filename, "rb") as fp:
+                result["findings"] = sum(1 for _line in fp)
+        results[name] = result
+        print(
+            f"{info['files']:>9} files  {name:<18} {wall_seconds:8.2f}s  {result['files_per_second']:9.0f} files/s  {result['max_rss_kib'] / 1024:7.1f} MiB peak RSS",
+            file=sys.stderr,
+        )
+        if runs[-1]["exit_code"] != 0:
+            print(f"ERROR: {name} failed with exit code {runs[-1]['exit_code']}, see {stderr_filename}", file=sys.stderr)
+            break
+    return results
+
+
+def git_commit():
+    try:
+        result = subprocess.run(["git", "-C", SCRIPT_DIR, "rev-parse", "HEAD"], capture_output=True, text=True)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def run(args):
+    workdir = args.workdir
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix="sysexpect-benchmark-")
+    results = {
+        "format": RESULTS_FORMAT_VERSION,
+        "label": args.label,
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+        },
+        "commit": git_commit(),
+        "config": {
+            **{setting: getattr(args, setting) for setting in GENERATOR_SETTINGS},
+            "format": args.format,
+            "repeat": args.repeat,
+            "deb2fsexpect_args": args.deb2fsexpect_args,
+            "merge_args": args.merge_args,
+            "check_args": args.check_args,
+        },
+        "scales": [],
+    }
+    try:
+        for files in sorted(set(args.scale)):
+            scale_dir = os.path.join(workdir, f"scale-{files}")
+            info = generate(scale_dir, files, args)
+            results["scales"].append({**info, "steps": run_scale(scale_dir, info, args)})
+            # Written after each scale, so that a long run that gets interrupted still leaves something.
+            with open(args.output, "w") as fp:
+                json.dump(results, fp, indent=1)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+    print(f"Results written to {args.output}", file=sys.stderr)
+
+
+def compare(old_filename, new_filename):
+    with open(old_filename, "r") as fp:
+        old = json.load(fp)
+    with open(new_filename, "r") as fp:
+        new = json.load(fp)
+    if old["config"] != new["config"]:
+        print("Warning: The runs used different settings, so they are not directly comparable.")
+    old_scales = {scale["files"]: scale for scale in old["scales"]}
+    for new_scale in new["scales"]:
+        old_scale = old_scales.get(new_scale["files"])
+        if old_scale is None:
+            continue
+        for name, new_step in new_scale["steps"].items():
+            old_step = old_scale["steps"].get(name)
+            if old_step is None:
+                continue
+            time_change = new_step["wall_seconds"] / max(old_step["wall_seconds"], 1e-6) - 1
+            rss_change = new_step["max_rss_kib"] / max(old_step["max_rss_kib"], 1) - 1
+            print(
+                f"{new_scale['files']:>9} files  {name:<18} {old_step['wall_seconds']:8.2f}s -> {new_step['wall_seconds']:8.2f}s ({time_change:+7.1%})  {old_step['max_rss_kib'] / 1024:7.1f} -> {new_step['max_rss_kib'] / 1024:7.1f} MiB peak RSS ({rss_change:+7.1%})"
+            )
+
+
+def measure_memory(filename):
+    """
+    Loads all expectations from the file at once, as plain dicts and as compact records, and
+    prints how much memory each of them takes.
+    """
+    for label, convert in [("dicts", lambda expectation: expectation), ("records", expectation_record.compact)]:
+        tracemalloc.start()
+        expectations = [convert(expectation) for expectation in expectation_io.open_expectations(filename)]
+        count = len(expectations)
+        # Only count what is freed along with the expectations, not caches and such.
+        size = tracemalloc.get_traced_memory()[0]
+        del expectations
+        size -= tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f"{label:<8} {size / 2**20:8.1f} MiB for {count} expectations ({size / max(count, 1):.0f} bytes each)")
+
+
+def build_memory_parser():
+    parser = argparse.ArgumentParser(
+        prog=f"{sys.argv[0]} memory",
+        description="Compares the memory needed to keep all expectations of a file in memory, as plain dicts and as compact records.",
+    )
+    parser.add_argument("filename", metavar="EXPECTATIONS.json_or_sqlite")
+    return parser
+
+
+def build_compare_parser():
+    parser = argparse.ArgumentParser(
+        prog=f"{sys.argv[0]} compare",
+        description="Compares the wall-clock time and peak RSS of each step in two results files.",
+    )
+    parser.add_argument("old_filename", metavar="OLD.json")
+    parser.add_argument("new_filename", metavar="NEW.json")
+    return parser
+
+
+def fraction(text):
+    value = float(text)
+    if not 0 <= value <= 1:
+        raise argparse.ArgumentTypeError(f"must be between 0 and 1, got {text!r}")
+    return value
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description=f"Benchmarks deb2fsexpect.py, merge_expectations.py and check_expect.py on synthetic data. Use '{sys.argv[0]} compare OLD.json NEW.json' to compare two runs."
+    )
+    parser.add_argument(
+        "--scale",
+        type=parse_count,
+        action="append",
+        help=f"Total number of files (not counting directories), e.g. '10k' or '5M'. Can be specified multiple times. Note that the data needs roughly 2 * files * average size of disk space. (default: {', '.join(DEFAULT_SCALES)})",
+    )
+    parser.add_argument(
+        "--workdir",
+        help="Where to generate the data. It is kept, and reused if the generator settings match. (default: a temporary directory, removed at the end)",
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        default=f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json",
+        help="Where to write the results. (default: benchmark-DATE-TIME.json)",
+    )
+    parser.add_argument(
+        "--label",
+        help="Free-form description of this run, stored in the results. (default: none)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=parse_count,
+        default=1,
+        help="Run each step this many times, and record the median wall-clock time. (default: 1)",
+    )
+    parser.add_argument(
+        "--files-per-deb",
+        type=parse_count,
+        default=1000,
+        help="Number of files in each generated .deb. (default: 1000)",
+    )
+    parser.add_argument(
+        "--sizes",
+        type=parse_sizes,
+        default=parse_sizes(DEFAULT_SIZES),
+        metavar="SIZE:WEIGHT,...",
+        help=f"Distribution of file sizes; each file is between half and 1.5 times the chosen size. (default: {DEFAULT_SIZES})",
+    )
+    parser.add_argument(
+        "--hardlink-fraction",
+        type=fraction,
+        default=0.01,
+        help="Fraction of files that are hardlinks to another file of the same package. (default: 0.01)",
+    )
+    parser.add_argument(
+        "--symlink-fraction",
+        type=fraction,
+        default=0.05,
+        help="Fraction of files that are symlinks. (default: 0.05)",
+    )
+    parser.add_argument(
+        "--xattr-fraction",
+        type=fraction,
+        default=0.01,
+        help=f"Fraction of regular files in the tree that get an (unexpected) '{XATTR_NAME}' xattr. (default: 0.01)",
+    )
+    parser.add_argument(
+        "--drift-fraction",
+        type=fraction,
+        default=0.001,
+        help=f"Fraction of files in the tree that differ from their .deb: {'; '.join(f'{filetype}: ' + ', '.join(kinds) for filetype, kinds in DRIFT_KINDS.items())}. (default: 0.001)",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=["gz", "xz", "none"],
+        default="gz",
+        help="Compression of data.tar in the generated .debs. (default: gz)",
+    )
+    parser.add_argument(
+        "--seed",
+        default="0",
+        help="Seed for generating the data. (default: 0)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["json", "sqlite"],
+        default="sqlite",
+        help="Output format of merge_expectations.py, and therefore input format of check_expect.py. (default: sqlite)",
+    )
+    parser.add_argument(
+        "--deb2fsexpect-args",
+        default="",
+        metavar="ARGS",
+        help="Additional arguments for deb2fsexpect.py, e.g. --deb2fsexpect-args='--jobs 4'. (default: none)",
+    )
+    parser.add_argument(
+        "--merge-args",
+        default="",
+        metavar="ARGS",
+        help="Additional arguments for merge_expectations.py. (default: none)",
+    )
+    parser.add_argument(
+        "--check-args",
+        default="",
+        metavar="ARGS",
+        help="Additional arguments for check_expect.py, e.g. --check-args='--walk --jobs 8'. (default: none)",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["compare"]:
+        args = build_compare_parser().parse_args(sys.argv[2:])
+        compare(args.old_filename, args.new_filename)
+        exit(0)
+    if sys.argv[1:2] == ["memory"]:
+        measure_memory(build_memory_parser().parse_args(sys.argv[2:]).filename)
+        exit(0)
+    args = build_parser().parse_args()
+    if args.scale is None:
+        args.scale = [parse_count(scale) for scale in DEFAULT_SCALES]
+    run(args)
@@ -3,10 +3,30 @@
 from debian import debfile
 import argparse
 import base64
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import expectation_io
+import expectation_record
+import expectation_store
+import fcntl
+import fs_watch
 import hashlib
+import ignore_rules
+import instrumentation
+import itertools
 import json
 import os
+import queue
+import report_sink
+import select
+import struct
 import sys
+import threading
+import time
+import zlib
 
 try:
     import xattr
@@ -54,6 +74,48 @@ S_IXOTH = 0o001
 
 MAX_MTIME_DIFF = 2
 
+IGNORABLE_ATTRIBUTES = [
+    "filetype",
+    "mode",
+    "uid",
+    "gid",
+    "size",
+    "sha256",
+    "extraneous_children",
+    "dev_inode",
+    "mtime",
+    "linkname",
+    "hardlink",
+    "xattr_base64",
+]
+
+# How many checks may be queued per worker thread. Results must be emitted in order,
+# so this bounds how many finished-but-not-yet-emitted reports can pile up behind a slow one.
+JOBS_QUEUE_FACTOR = 4
+
+# Large reads keep spinning disks streaming, instead of seeking between files all the time.
+HASH_BUFFER_SIZE = 1024 * 1024
+# While hashing a file that wasn't in the page cache, drop what has been read every this many bytes,
+# so that even a huge file doesn't fill the page cache on its way.
+DROP_CACHE_INTERVAL = 8 * 1024 * 1024
+# How far the fastest of several --destdir roots may get ahead of the slowest one, in expectations.
+BROADCAST_QUEUE_SIZE = 1024
+# How many checks are reordered at once by --io-order. Also bounds the number of buffered reports.
+IO_SCHEDULE_WINDOW = 4096
+# How many reports may be held back while waiting for the destination of a hardlink to be checked,
+# before it is stat'ed instead (see resolve_links).
+LINK_WAIT_LIMIT = 4096
+# From /usr/include/linux/fs.h and /usr/include/linux/fiemap.h
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct("=QQLLLL")
+FIEMAP_EXTENT = struct.Struct("=QQQQQLLLL")
+
+HASH_CACHE_VERSION = 1
+# Files whose ctime is this close to (or after) the start of the run are not cached:
+# A modification within the same timestamp tick would not change the key. 2 seconds covers
+# even the coarsest filesystems (FAT).
+HASH_CACHE_RACY_NS = 2 * 10**9
+
 
 def simplify_mode(stat_mode):
     fmt_bits = stat_mode & S_IFMT
@@ -90,20 +152,413 @@ def fetch_actual_xattr_dict(filename):
     return dict(xattr.xattr(filename, xattr.XATTR_NOFOLLOW))
 
 
-def check_expectation(args, expectation):
+def hash_cache_key(stat_result):
+    # ctime is included on purpose: mtime can be reset by anyone who can write the file, ctime cannot.
+    return (
+        stat_result.st_dev,
+        stat_result.st_ino,
+        stat_result.st_size,
+        stat_result.st_mtime_ns,
+        stat_result.st_ctime_ns,
+    )
+
+
+class HashCache:
+    """
+    On-disk cache of sha256 digests, keyed by hash_cache_key(). Only the entries that were
+    looked up or added during this run are written back, so stale entries are evicted
+    automatically, and the file never grows beyond the number of checked files.
+    """
+
+    def __init__(self, filename, verify):
+        self.filename = filename
+        # If set, never trust the old entries, but still write back fresh ones.
+        self.verify = verify
+        self.started_ns = time.time_ns()
+        self.old_entries = dict()
+        self.new_entries = dict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        try:
+            with open(filename, "r") as fp:
+                data = json.load(fp)
+        except FileNotFoundError:
+            return
+        if data.get("version") != HASH_CACHE_VERSION:
+            print(f"Warning: Ignoring hash cache {filename} with unknown version", file=sys.stderr)
+            return
+        for *key, sha256 in data["entries"]:
+            self.old_entries[tuple(key)] = sha256
+
+    def lookup(self, stat_result):
+        key = hash_cache_key(stat_result)
+        with self.lock:
+            sha256 = None if self.verify else self.old_entries.get(key)
+            if sha256 is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.new_entries[key] = sha256
+        return sha256
+
+    def store(self, stat_result, sha256):
+        if stat_result.st_ctime_ns >= self.started_ns - HASH_CACHE_RACY_NS:
+            return
+        with self.lock:
+            self.new_entries[hash_cache_key(stat_result)] = sha256
+
+    def save(self, compact=True):
+        """
+        If compact is False, keeps the unused entries, e.g. because only part of the system was checked.
+        """
+        if not compact:
+            self.old_entries.update(self.new_entries)
+            self.new_entries = self.old_entries
+        entries = [[*key, sha256] for key, sha256 in self.new_entries.items()]
+        entries.sort()
+        temp_filename = self.filename + ".tmp"
+        with open(temp_filename, "w") as fp:
+            json.dump(dict(version=HASH_CACHE_VERSION, entries=entries), fp)
+        os.replace(temp_filename, self.filename)
+        evicted = len(self.old_entries.keys() - self.new_entries.keys())
+        print(
+            f"Hash cache: {self.hits} hits, {self.misses} misses, {evicted} stale entries evicted",
+            file=sys.stderr,
+        )
+
+
+class HashMemo:
+    """
+    Remembers the sha256 of files hashed during this run, keyed by hash_cache_key() (so by
+    device and inode), so that each inode is read only once, even if several threads get to it
+    at the same time. This covers hardlinks, which are common between packages, and files shared
+    between several --destdir roots (bind mounts, the same image mounted twice, ...).
+
+    Only files that can come up again are remembered, since the others would only cost memory:
+    Those with st_nlink > 1, and those on one of the 'shared_devices', which can be reached
+    through more than one root (see shared_devices()).
+    """
+
+    def __init__(self, shared_devices=frozenset()):
+        self.shared_devices = shared_devices
+        # Maps keys to the sha256, or to a threading.Event while some thread is hashing the file.
+        self.entries = dict()
+        self.lock = threading.Lock()
+
+    def covers(self, stat_result):
+        return stat_result.st_nlink > 1 or stat_result.st_dev in self.shared_devices
+
+    def lookup(self, stat_result):
+        """
+        Returns the sha256 if known. Otherwise returns None, and the caller must hash the file
+        and call store() in any case, even if that fails. If another thread is already hashing
+        the same file, waits for it first.
+        """
+        key = hash_cache_key(stat_result)
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is None:
+                    self.entries[key] = threading.Event()
+                    return None
+                if not isinstance(entry, threading.Event):
+                    return entry
+            entry.wait()
+
+    def store(self, stat_result, sha256):
+        """
+        sha256 may be None if hashing failed, so that the next caller tries again.
+        """
+        key = hash_cache_key(stat_result)
+        with self.lock:
+            entry = self.entries.get(key)
+            if sha256 is not None:
+                self.entries[key] = sha256
+            elif isinstance(entry, threading.Event):
+                del self.entries[key]
+        if isinstance(entry, threading.Event):
+            entry.set()
+
+
+def root_devices(destdir):
+    """
+    Returns the st_dev of each filesystem that can be reached through the given root.
+    """
+    root = os.path.realpath(destdir)
+    try:
+        mount_points = [root] + fs_watch.mount_points_below(root)
+    except OSError:
+        # No /proc, so at least the root itself.
+        mount_points = [root]
+    devices = set()
+    for mount_point in mount_points:
+        try:
+            devices.add(os.stat(mount_point).st_dev)
+        except OSError:
+            pass
+    return devices
+
+
+def shared_devices(destdirs):
+    """
+    Returns the st_dev of each filesystem that can be reached through more than one of the roots,
+    e.g. because they are bind mounts of each other, or one is mounted below the other.
+    """
+    seen = set()
+    shared = set()
+    for destdir in destdirs:
+        devices = root_devices(destdir)
+        shared |= seen & devices
+        seen |= devices
+    return frozenset(shared)
+
+
+class InodeIndex:
+    """
+    Remembers every checked non-directory with st_nlink > 1, so that hardlink expectations can be
+    resolved without stat'ing the link destination again, and so that hardlinks which are not
+    declared in the expectations can be reported at the end.
+    """
+
+    def __init__(self):
+        # Maps keys like 'usr/bin/foo' to (st_dev, st_ino), and (st_dev, st_ino) to
+        # [st_nlink, list of names].
+        self.key_to_ident = dict()
+        self.ident_to_names = dict()
+        # Pairs of (name, linkname) for each 'lnk' expectation.
+        self.declared_links = []
+        # Maps the names of 'lnk' expectations whose destination wasn't known yet to their (st_dev, st_ino).
+        self.pending_links = dict()
+        self.lock = threading.Lock()
+
+    def add(self, expectation, stat_result):
+        ident = (stat_result.st_dev, stat_result.st_ino)
+        key = expectation_io.parts_to_key(expectation_io.name_to_parts(expectation["name"]))
+        with self.lock:
+            self.key_to_ident[key] = ident
+            self.ident_to_names.setdefault(ident, [stat_result.st_nlink, []])[1].append(expectation["name"])
+            if expectation["filetype"] == "lnk":
+                self.declared_links.append((expectation["name"], expectation["linkname"]))
+
+    def lookup(self, name):
+        key = expectation_io.parts_to_key(expectation_io.name_to_parts(name))
+        with self.lock:
+            return self.key_to_ident.get(key)
+
+    def add_link(self, expectation, ident):
+        with self.lock:
+            self.pending_links[expectation["name"]] = ident
+
+    def pop_link(self, expectation):
+        with self.lock:
+            return self.pending_links.pop(expectation["name"], None)
+
+    def final_reports(self, complete=True):
+        """
+        Yields a report for each group of expected files that share an inode without being
+        declared as hardlinks of each other, and for each inode that has more links than
+        the expectations can account for. The latter only makes sense if 'complete', i.e.
+        if all expectations were checked.
+        """
+        # Union-find over the names, connected by declared hardlinks.
+        group_of = dict()
+
+        def find(name):
+            while group_of.get(name, name) != name:
+                name = group_of[name]
+            return name
+
+        for name, linkname in self.declared_links:
+            name = expectation_io.parts_to_key(expectation_io.name_to_parts(name))
+            linkname = expectation_io.parts_to_key(expectation_io.name_to_parts(linkname))
+            group_of[find(name)] = find(linkname)
+        groups = [(sorted(names), nlink) for nlink, names in self.ident_to_names.values()]
+        groups.sort()
+        for names, nlink in groups:
+            roots = {find(expectation_io.parts_to_key(expectation_io.name_to_parts(name))) for name in names}
+            if len(roots) > 1:
+                yield dict(name=names[0], unexpected_hardlinks=names)
+            elif complete and nlink > len(names):
+                # The remaining links are somewhere outside of the expectations.
+                yield dict(name=names[0], hardlink_count={"expected": len(names), "actual": nlink})
+
+
+def is_in_page_cache(fd):
+    """
+    Returns whether the beginning of the file is already cached, or None if we can't tell.
+    """
+    if getattr(os, "RWF_NOWAIT", None) is None:
+        return None
+    try:
+        # RWF_NOWAIT refuses to read anything that is not already in the page cache.
+        os.preadv(fd, [bytearray(1)], 0, os.RWF_NOWAIT)
+    except BlockingIOError:
+        return False
+    except OSError:
+        return None
+    return True
+
+
+def read_full(fp, view):
+    """
+    Like fp.readinto(view), but only returns less than len(view) at the end of the file.
+    """
+    size_read = 0
+    while size_read < len(view):
+        n = fp.readinto(view[size_read:])
+        if not n:
+            break
+        size_read += n
+    return size_read
+
+
+def digest_file(fp, size, chunk_size=HASH_BUFFER_SIZE, on_chunk=None, whole=True):
+    """
+    Like hashlib.file_digest, but with a larger buffer, and without leaving the file in the
+    page cache if it wasn't there before. This way, checking the entire system does not push
+    the working set of everything else out of the cache.
+    If given, on_chunk(offset, data) is called for each chunk of chunk_size bytes (the last one
+    may be shorter). If it returns False, reading stops early, and the result is None.
+    If whole is False, only on_chunk gets to see the data, and the result is None, too.
+    """
+    fd = fp.fileno()
+    was_cached = is_in_page_cache(fd) if size > 0 else True
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    digest = hashlib.sha256()
+    view = memoryview(bytearray(chunk_size))
+    offset = 0
+    # Everything before this offset has been dropped from the page cache already.
+    dropped = 0
+    complete = True
+    while True:
+        size_read = read_full(fp, view)
+        if not size_read:
+            break
+        if whole:
+            digest.update(view[:size_read])
+        if on_chunk is not None and not on_chunk(offset, view[:size_read]):
+            complete = False
+            break
+        offset += size_read
+        if was_cached is False and offset - dropped >= DROP_CACHE_INTERVAL:
+            os.posix_fadvise(fd, dropped, offset - dropped, os.POSIX_FADV_DONTNEED)
+            dropped = offset
+    if was_cached is False:
+        # The rest, up to the end of the file.
+        os.posix_fadvise(fd, dropped, 0, os.POSIX_FADV_DONTNEED)
+    return digest.hexdigest() if complete and whole else None
+
+
+def add_range(ranges, start, end):
+    # Adjacent ranges are merged, so a long differing region is reported only once.
+    if ranges and ranges[-1][1] == start:
+        ranges[-1][1] = end
+    else:
+        ranges.append([start, end])
+
+
+def hash_file(args, effective_path, stat_result, expectation):
+    """
+    Returns a tuple of two values:
+    - The sha256 of the file, or None if reading stopped at the first differing chunk (--fail-fast).
+    - If the expectation has per-chunk digests and the file differs, the list of differing byte
+      ranges as [start, end), otherwise None.
+    """
+    chunks = expectation.get("chunks")
+
+    def is_usable(sha256):
+        # If the file has chunks and differs, it needs to be read anyway to find out where.
+        return sha256 is not None and (chunks is None or sha256 == expectation["sha256"])
+
+    if args.hash_cache is not None:
+        cached_sha256 = args.hash_cache.lookup(stat_result)
+        if is_usable(cached_sha256):
+            return cached_sha256, None
+    memo = args.hash_memo if args.hash_memo.covers(stat_result) else None
+    if memo is not None:
+        known_sha256 = memo.lookup(stat_result)
+        if is_usable(known_sha256):
+            args.stats.count("hash_memo_hits")
+            return known_sha256, None
+    actual_sha256 = None
+    ranges = None
+    is_same_file = False
+    try:
+        with open(effective_path, "rb", buffering=0) as fp:
+            if chunks is None:
+                actual_sha256 = digest_file(fp, stat_result.st_size)
+            else:
+                ranges = []
+
+                def compare_chunk(offset, data):
+                    index = offset // chunks["size"]
+                    if index < len(chunks["sha256"]) and hashlib.sha256(data).hexdigest() == chunks["sha256"][index]:
+                        return True
+                    add_range(ranges, offset, offset + len(data))
+                    return not args.fail_fast
+
+                digest_file(fp, stat_result.st_size, chunks["size"], compare_chunk, whole=False)
+                is_complete = not ranges or not args.fail_fast
+                if is_complete and stat_result.st_size < expectation["size"]:
+                    # The file was truncated, so the rest of the expected content is missing entirely.
+                    add_range(ranges, stat_result.st_size, expectation["size"])
+                if not ranges:
+                    # Every chunk matches, and nothing is missing or left over, so the whole file matches, too.
+                    actual_sha256 = expectation["sha256"]
+                elif is_complete:
+                    # Only worth reading the file a second time if it differs.
+                    args.stats.count("bytes_hashed", fp.tell())
+                    fp.seek(0)
+                    actual_sha256 = digest_file(fp, stat_result.st_size)
+            args.stats.count("bytes_hashed", fp.tell())
+            # Only remember the digest if we are sure it belongs to exactly the file we stat'ed earlier.
+            is_same_file = hash_cache_key(os.fstat(fp.fileno())) == hash_cache_key(stat_result)
+    finally:
+        if memo is not None:
+            memo.store(stat_result, actual_sha256 if is_same_file else None)
+    if args.hash_cache is not None and actual_sha256 is not None and is_same_file:
+        args.hash_cache.store(stat_result, actual_sha256)
+    return actual_sha256, ranges or None
+
+
+def wants_content_check(args, expectation):
+    """
+    Whether the content of this file should be read and hashed in this run, depending on --level.
+    """
+    if args.level == "full":
+        return True
+    if args.level == "meta":
+        return False
+    # Deterministic, so that every file is hashed exactly once every args.sample_fraction slots.
+    bucket = zlib.crc32(expectation["name"].encode("utf-8", "surrogateescape")) % args.sample_fraction
+    return bucket == args.sample_slot % args.sample_fraction
+
+
+def check_expectation(args, expectation, stat_result=None, actual_children=None):
+    """
+    Returns a report if the file does not satisfy the expectation, otherwise None.
+    If the caller already knows the stat_result or the list of actual_children of the file,
+    it can pass them in to save the corresponding syscalls.
+    """
     assert expectation["type"] == "file", f"Can't handle type {expectation['type']}"
     effective_path = args.destdir + expectation["name"]
+    parts = expectation_io.name_to_parts(expectation["name"])
+    ignored = args.ignore_rules.ignored_attributes(parts)
+    if not wants_content_check(args, expectation):
+        ignored.add("sha256")
     report = dict(name=expectation["name"])
-    # TODO: if stat.st_nlink > 1, cache it somehow for easier hardlink checks
     has_any_conflict = False
-    try:
-        stat_result = os.stat(effective_path, follow_symlinks=False)
-    except FileNotFoundError:
-        report["error_stat"] = "FileNotFoundError"
-        return report
-    except PermissionError:
-        report["error_stat"] = "PermissionError during stat (try running as root)"
-        return report
+    if stat_result is None:
+        try:
+            with args.stats.phase("stat"):
+                stat_result = os.stat(effective_path, follow_symlinks=False)
+        except FileNotFoundError:
+            report["error_stat"] = "FileNotFoundError"
+            return report
+        except PermissionError:
+            report["error_stat"] = "PermissionError during stat (try running as root)"
+            return report
     actual_filetype, actual_mode = simplify_mode(stat_result.st_mode)
     expected_filetype = expectation["filetype"]
     if expected_filetype == "lnk":
@@ -117,49 +572,66 @@ def check_expectation(args, expectation):
     has_any_conflict |= check_for_conflict(
         report, "mode", actual_mode, expectation["mode"]
     )
-    # TODO: Save (st_dev, st_ino) to identify hardlinks later
-    # TODO: Use st_nlink to speed up hardlink detection
+    if stat_result.st_nlink > 1 and actual_filetype != "dir":
+        args.inode_index.add(expectation, stat_result)
     has_any_conflict |= check_for_conflict(
         report, "uid", stat_result.st_uid, expectation["uid"]
     )
     has_any_conflict |= check_for_conflict(
         report, "gid", stat_result.st_gid, expectation["gid"]
     )
+    size_differs = False
     if actual_filetype == "reg":
-        has_any_conflict |= check_for_conflict(
+        size_differs = check_for_conflict(
             report, "size", stat_result.st_size, expectation["size"]
         )
-    if actual_filetype == "reg":
+        has_any_conflict |= size_differs
+    should_hash = actual_filetype == "reg" and "sha256" not in ignored
+    if should_hash and size_differs and "size" not in ignored and "chunks" not in expectation:
+        # The content can't match anyway, and the size conflict is already reported. With chunks,
+        # reading still tells which parts of e.g. a truncated file are intact.
+        args.stats.count("hash_skipped_size")
+        should_hash = False
+    if should_hash:
         try:
-            with open(effective_path, "rb") as fp:
-                actual_sha256 = hashlib.file_digest(fp, "sha256").hexdigest()
+            with args.stats.phase("hash"):
+                actual_sha256, differing_ranges = hash_file(args, effective_path, stat_result, expectation)
         except PermissionError:
             report["error_read"] = "PermissionError during read (try running as root)"
             has_any_conflict = True
-            actual_sha256 = None
-        if actual_sha256 is not None:
+            actual_sha256, differing_ranges = None, None
+        if differing_ranges is not None and actual_sha256 != expectation["sha256"]:
+            # With --fail-fast, actual_sha256 is None, since reading stopped at the first differing chunk.
+            report["sha256"] = {
+                "expected": expectation["sha256"],
+                "actual": actual_sha256,
+                "differing_ranges": differing_ranges,
+            }
+            has_any_conflict = True
+        elif actual_sha256 is not None:
             has_any_conflict |= check_for_conflict(
                 report, "sha256", actual_sha256, expectation["sha256"]
             )
     should_check_children = actual_filetype == "dir" and expectation["filetype"] == "dir"
     should_check_children &= expectation["children"] is not None
-    should_check_children &= expectation["name"][1:] not in args.ignore_children_of_dir
-    should_check_children &= effective_path not in args.ignore_children_of_dir
-    # TODO: Report unused entries in "ignore_children_of_dir".
+    should_check_children &= "extraneous_children" not in ignored
+    should_check_children &= not args.ignore_rules.ignores_children_of(parts)
     if should_check_children:
-        try:
-            actual_children = os.listdir(effective_path)
-        except PermissionError:
-            actual_children = []
-            report["error_listdir"] = "PermissionError during listdir (try running as root)"
-            has_any_conflict = True
+        if actual_children is None:
+            try:
+                with args.stats.phase("listdir"):
+                    actual_children = os.listdir(effective_path)
+            except PermissionError:
+                actual_children = []
+                report["error_listdir"] = "PermissionError during listdir (try running as root)"
+                has_any_conflict = True
         # Any missing children will be reported through their respective expectation entry.
         # Therefore, only report extraneous children here:
         actual_children = set(actual_children)
         actual_children.difference_update(expectation["children"])
-        if args.ignore_pycache:
-            actual_children.discard("__pycache__")
-        extraneous_children = list(actual_children)
+        extraneous_children = [
+            child for child in actual_children if not args.ignore_rules.ignores_extraneous(parts + (child,))
+        ]
         extraneous_children.sort()
         if extraneous_children:
             has_any_conflict = True
@@ -169,7 +641,7 @@ def check_expectation(args, expectation):
         has_any_conflict |= check_for_conflict(
             report, "dev_inode", actual_dev_inode, expectation["dev_inode"]
         )
-    if expectation["mtime"] is not None and actual_filetype != "dir" and not args.ignore_mtime:
+    if expectation["mtime"] is not None and actual_filetype != "dir" and "mtime" not in ignored:
         mtime_diff = abs(expectation["mtime"] - stat_result.st_mtime)
         if mtime_diff > MAX_MTIME_DIFF:
             has_any_conflict = True
@@ -179,33 +651,35 @@ def check_expectation(args, expectation):
             }
     if expectation["linkname"] is not None:
         if expectation["filetype"] == "sym":
-            if actual_filetype == "sym":
-                actual_destination = os.readlink(effective_path)
+            if "linkname" in ignored:
+                pass
+            elif actual_filetype == "sym":
+                with args.stats.phase("readlink"):
+                    actual_destination = os.readlink(effective_path)
                 has_any_conflict |= check_for_conflict(
                     report, "linkname", actual_destination, expectation["linkname"]
                 )
             else:
                 report["symlink"] = "Uncheckable; actual is not a symlink"
                 assert has_any_conflict
+        elif expectation["filetype"] == "lnk" and "hardlink" in ignored:
+            pass
         elif expectation["filetype"] == "lnk":
-            try:
-                stat_other = os.stat(args.destdir + expectation["linkname"], follow_symlinks=False)
-            except:
-                has_any_conflict = True
-                report["error_stat_link_dest"] = "PermissionError during stat (try running as root)"
+            this_ident = (stat_result.st_dev, stat_result.st_ino)
+            # Usually, the destination has been checked already, so there's no need to stat it again.
+            if args.inode_index.lookup(expectation["linkname"]) is not None:
+                has_any_conflict |= check_link(args, report, expectation, this_ident)
             else:
-                this_ident = (stat_result.st_dev, stat_result.st_ino)
-                other_ident = (stat_other.st_dev, stat_other.st_ino)
-                if this_ident != other_ident:
-                    has_any_conflict = True
-                    report["hardlink"] = {"this_file": this_ident, "expected": other_ident}
+                # It may still be checked later, or concurrently, see resolve_links.
+                args.inode_index.add_link(expectation, this_ident)
         else:
             raise AssertionError(
                 f"non-linking filetype {expectation['filetype']} tries to link to {expectation['linkname']}?!"
             )
-    if CAN_CHECK_XATTR:
+    if CAN_CHECK_XATTR and "xattr_base64" not in ignored:
         try:
-            actual_xattr = fetch_actual_xattr_dict(effective_path)
+            with args.stats.phase("xattr"):
+                actual_xattr = fetch_actual_xattr_dict(effective_path)
         except PermissionError:
             has_any_conflict = True
             report["error_xattr"] = "PermissionError during xattr (try running as root)"
@@ -217,29 +691,694 @@ def check_expectation(args, expectation):
                 report, "xattr_base64", base64_xattr, expected_xattr
             )
 
-    if has_any_conflict:
+    # Cheap checks are simply done anyway, and then dropped here:
+    for key in ignored:
+        report.pop(key, None)
+    if len(report) > 1:
         return report
-    assert len(report) == 1, report
+    assert not has_any_conflict or ignored, report
     return None
 
 
+def check_link(args, report, expectation, this_ident):
+    """
+    Adds a finding to the report if the file (this_ident) is not the same as the link destination.
+    Only stats the destination if it isn't in the inode index. Returns whether there was a finding.
+    """
+    other_ident = args.inode_index.lookup(expectation["linkname"])
+    if other_ident is None:
+        try:
+            with args.stats.phase("stat"):
+                stat_other = os.stat(args.destdir + expectation["linkname"], follow_symlinks=False)
+        except:
+            report["error_stat_link_dest"] = "PermissionError during stat (try running as root)"
+            return True
+        other_ident = (stat_other.st_dev, stat_other.st_ino)
+    if this_ident != other_ident:
+        report["hardlink"] = {"this_file": this_ident, "expected": other_ident}
+        return True
+    return False
+
+
+def resolve_links(args, results):
+    """
+    Passes on the (expectation, report) pairs of check_expectations, but adds the findings of the
+    hardlinks that check_expectation couldn't resolve yet. If the destination comes later, this
+    path and all after it are held back until the destination has been checked, so that the
+    output stays in order. After LINK_WAIT_LIMIT paths, the destination is stat'ed instead.
+    """
+    # Entries of [expectation, report, this_ident], where this_ident is None once resolved.
+    held = collections.deque()
+    # Maps the keys of destinations that come later to the entries waiting for them.
+    waiting = dict()
+
+    def resolve(entry):
+        expectation, report, this_ident = entry
+        if this_ident is None:
+            return
+        report = report or dict(name=expectation["name"])
+        if check_link(args, report, expectation, this_ident):
+            entry[1] = report
+        entry[2] = None
+
+    for expectation, report in results:
+        parts = expectation_io.name_to_parts(expectation["name"])
+        # This is the destination of the entries waiting for it, and it's in the index now (if hardlinked at all).
+        for entry in waiting.pop(expectation_io.parts_to_key(parts), ()):
+            resolve(entry)
+        entry = [expectation, report, args.inode_index.pop_link(expectation)]
+        if entry[2] is not None:
+            destination_parts = expectation_io.name_to_parts(expectation["linkname"])
+            if expectation_io.parts_sort_key(destination_parts) > expectation_io.parts_sort_key(parts):
+                waiting.setdefault(expectation_io.parts_to_key(destination_parts), []).append(entry)
+            else:
+                # Checked before, or at the same time.
+                resolve(entry)
+        held.append(entry)
+        if len(held) > LINK_WAIT_LIMIT:
+            resolve(held[0])
+        while held and held[0][2] is None:
+            yield tuple(held.popleft()[:2])
+    # The remaining destinations weren't checked at all.
+    for entry in held:
+        resolve(entry)
+        yield tuple(entry[:2])
+
+
+def check_expectation_timed(args, expectation, stat_result=None, actual_children=None):
+    """
+    Same as check_expectation, but also records how long it took, for --stats.
+    """
+    started = time.perf_counter()
+    try:
+        return check_expectation(args, expectation, stat_result, actual_children)
+    finally:
+        args.stats.record_path(expectation["name"], time.perf_counter() - started)
+        args.stats.count("files")
+
+
+def plain_work(args, expectations):
+    """
+    Yields the arguments for check_expectation, letting it stat each file by its full path.
+    """
+    for expectation in expectations:
+        yield expectation, None, None
+
+
+class OpenDir:
+    def __init__(self, parts, fd, child_names):
+        self.parts = parts
+        # Both are None if the directory could not be opened.
+        self.fd = fd
+        self.child_names = child_names
+
+
+def enter_dir(args, open_dirs, parts):
+    """
+    Makes sure that open_dirs is exactly the chain of directories from --destdir down to 'parts'.
+    Each directory is opened and scanned once, when it is entered.
+    """
+    while open_dirs and open_dirs[-1].parts != parts[: len(open_dirs[-1].parts)]:
+        leave_dir(open_dirs)
+    while not open_dirs or open_dirs[-1].parts != parts:
+        # open_dirs[i] always belongs to parts[:i].
+        next_parts = parts[: len(open_dirs)]
+        fd = None
+        child_names = None
+        try:
+            if not open_dirs:
+                fd = os.open(args.destdir, os.O_RDONLY | os.O_DIRECTORY)
+            elif open_dirs[-1].fd is not None:
+                fd = os.open(next_parts[-1], os.O_RDONLY | os.O_DIRECTORY, dir_fd=open_dirs[-1].fd)
+            if fd is not None:
+                with args.stats.phase("listdir"), os.scandir(fd) as entries:
+                    child_names = {entry.name for entry in entries}
+        except OSError:
+            # check_expectation will run into the same problem and report it properly.
+            if fd is not None:
+                os.close(fd)
+            fd = None
+            child_names = None
+        open_dirs.append(OpenDir(next_parts, fd, child_names))
+
+
+def leave_dir(open_dirs):
+    open_dir = open_dirs.pop()
+    if open_dir.fd is not None:
+        os.close(open_dir.fd)
+
+
+def walk_work(args, expectations):
+    """
+    Yields the arguments for check_expectation, but walks --destdir alongside the expectations:
+    Each directory is opened and scanned only once, missing files are detected from the scan,
+    and everything else is stat'ed relative to its already-open parent directory instead of
+    resolving the full path from the root each time. This relies on the order of
+    merge_expectations.py, where each directory comes right after its contents. Any other order
+    still works, but directories may be scanned more than once.
+    """
+    open_dirs = []
+    try:
+        for expectation in expectations:
+            parts = expectation_io.name_to_parts(expectation["name"])
+            stat_result = None
+            is_scanned = bool(open_dirs) and open_dirs[-1].parts == parts
+            if is_scanned:
+                # Its contents came first, so it's still open, and was already scanned.
+                scanned_children = open_dirs[-1].child_names
+                leave_dir(open_dirs)
+            if parts:
+                enter_dir(args, open_dirs, parts[:-1])
+                parent = open_dirs[-1]
+                if parent.child_names is None or parts[-1] not in parent.child_names:
+                    # Let check_expectation figure out what exactly is wrong.
+                    yield expectation, None, None
+                    continue
+                try:
+                    with args.stats.phase("stat"):
+                        stat_result = os.stat(parts[-1], dir_fd=parent.fd, follow_symlinks=False)
+                except OSError:
+                    yield expectation, None, None
+                    continue
+            actual_children = None
+            wants_children = expectation["filetype"] == "dir" and expectation["children"] is not None
+            if wants_children and (stat_result is None or simplify_mode(stat_result.st_mode)[0] == "dir"):
+                if not is_scanned:
+                    # None of its contents were checked, e.g. because of --level or ignore rules.
+                    enter_dir(args, open_dirs, parts)
+                    scanned_children = open_dirs[-1].child_names
+                    leave_dir(open_dirs)
+                if scanned_children is not None:
+                    actual_children = list(scanned_children)
+            yield expectation, stat_result, actual_children
+    finally:
+        while open_dirs:
+            leave_dir(open_dirs)
+
+
+def check_expectations_parallel(args, work):
+    """
+    Yields the expectation and the result of check_expectation for each item of 'work', in the
+    same order, while running up to args.jobs checks concurrently.
+    """
+    # All the expensive parts (stat, read, sha256, listdir, xattr) release the GIL,
+    # so plain threads are good enough here.
+    max_in_flight = args.jobs * JOBS_QUEUE_FACTOR
+    in_flight = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        for item in work:
+            if len(in_flight) >= max_in_flight:
+                expectation, future = in_flight.popleft()
+                yield expectation, future.result()
+            in_flight.append((item[0], executor.submit(check_expectation_timed, args, *item)))
+        while in_flight:
+            expectation, future = in_flight.popleft()
+            yield expectation, future.result()
+
+
+def first_physical_offset(path):
+    """
+    Returns the physical location of the first extent of the file, or None if unknown.
+    """
+    request = bytearray(FIEMAP_HEADER.size + FIEMAP_EXTENT.size)
+    # fm_start, fm_length, fm_flags, fm_mapped_extents, fm_extent_count, fm_reserved
+    FIEMAP_HEADER.pack_into(request, 0, 0, 2**64 - 1, 0, 0, 1, 0)
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    except OSError:
+        return None
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+    mapped_extents = FIEMAP_HEADER.unpack_from(request, 0)[3]
+    if mapped_extents == 0:
+        return None
+    return FIEMAP_EXTENT.unpack_from(request, FIEMAP_HEADER.size)[1]
+
+
+def io_sort_key(args, item):
+    expectation, stat_result, _actual_children = item
+    if stat_result is None:
+        return (0, 0)
+    if args.io_order == "extent" and simplify_mode(stat_result.st_mode)[0] == "reg" and stat_result.st_size > 0:
+        physical_offset = first_physical_offset(args.destdir + expectation["name"])
+        if physical_offset is not None:
+            return (stat_result.st_dev, physical_offset)
+    # Inode numbers roughly correlate with the on-disk location on most filesystems.
+    return (stat_result.st_dev, stat_result.st_ino)
+
+
+def prefetch_stat(args, item):
+    expectation, stat_result, actual_children = item
+    if stat_result is None:
+        try:
+            with args.stats.phase("stat"):
+                stat_result = os.stat(args.destdir + expectation["name"], follow_symlinks=False)
+        except OSError:
+            # Let check_expectation report this.
+            pass
+    return expectation, stat_result, actual_children
+
+
+def prefetch_location(args, item):
+    """
+    Returns the item with its stat result filled in, along with its io_sort_key.
+    """
+    item = prefetch_stat(args, item)
+    return item, io_sort_key(args, item)
+
+
+def check_expectations_scheduled(args, work):
+    """
+    Yields the expectation and the result of check_expectation for each item of 'work', in the
+    same order, but actually runs them in windows of IO_SCHEDULE_WINDOW items, sorted by their
+    location on disk.
+    """
+    with contextlib.ExitStack() as stack:
+        executor = None
+        if args.jobs > 1:
+            executor = stack.enter_context(concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs))
+        work = iter(work)
+        while True:
+            items = list(itertools.islice(work, IO_SCHEDULE_WINDOW))
+            if not items:
+                return
+            if executor is None:
+                located = [prefetch_location(args, item) for item in items]
+            else:
+                # The stat and FIEMAP calls block on the disk too, so overlap them as well.
+                located = list(executor.map(prefetch_location, itertools.repeat(args), items))
+            window = [item for item, _sort_key in located]
+            sort_keys = [sort_key for _item, sort_key in located]
+            order = sorted(range(len(window)), key=sort_keys.__getitem__)
+            if executor is None:
+                results = dict((i, check_expectation_timed(args, *window[i])) for i in order)
+                yield from ((window[i][0], results[i]) for i in range(len(window)))
+            else:
+                futures = dict((i, executor.submit(check_expectation_timed, args, *window[i])) for i in order)
+                yield from ((window[i][0], futures[i].result()) for i in range(len(window)))
+
+
+def check_expectations(args, expectations):
+    """
+    Yields each (unpruned) expectation along with its report, or None if there are no findings.
+    """
+    expectations = (
+        expectation
+        for expectation in expectations
+        if not args.ignore_rules.is_pruned(expectation_io.name_to_parts(expectation["name"]))
+    )
+    if args.walk:
+        work = walk_work(args, expectations)
+    else:
+        work = plain_work(args, expectations)
+    if args.io_order != "name":
+        return check_expectations_scheduled(args, work)
+    if args.jobs > 1:
+        return check_expectations_parallel(args, work)
+    return ((item[0], check_expectation_timed(args, *item)) for item in work)
+
+
+def build_ignore_rules(args):
+    rules = ignore_rules.IgnoreRules(args.destdir)
+    for pattern in args.prune:
+        rules.add("prune", pattern, f"--prune {pattern}")
+    for pattern in args.ignore_children_of_dir:
+        rules.add("children", pattern, f"--ignore-children-of-dir {pattern}")
+    for pattern in args.ignore_extraneous:
+        rules.add("extraneous", pattern, f"--ignore-extraneous {pattern}")
+    if args.ignore_pycache:
+        rules.add("extraneous", "**/__pycache__", "--ignore-pycache")
+    for attribute_and_pattern in args.ignore_attr:
+        attribute, pattern = attribute_and_pattern.split(":", 1)
+        rules.add("attr", pattern, f"--ignore-attr {attribute_and_pattern}", attribute)
+    if args.ignore_mtime:
+        rules.add("attr", "/**", "--ignore-mtime", "mtime")
+    return rules
+
+
+def print_report(args, report, expectation=None):
+    with args.stats.phase("output"):
+        args.report_sink.write(report, expectation)
+
+
+def report_sinks(args, root=None, flush=False):
+    """
+    Returns the sinks for the output that was asked for on the command line.
+    """
+    sinks = []
+    if args.show_reports:
+        sinks.append(report_sink.JsonLinesSink(root=root, flush=flush))
+    return sinks
+
+
 def run_expectations(args, expectations):
     if not args.destdir.endswith("/"):
         args.destdir += "/"
-    reports = []
-    for expectation in expectations:
-        report = check_expectation(args, expectation)
+    args.inode_index = InodeIndex()
+    args.ignore_rules = build_ignore_rules(args)
+    for expectation, report in resolve_links(args, check_expectations(args, expectations)):
+        args.progress.update()
         if report is not None:
-            reports.append(report)
-            print(json.dumps(report))
-    return reports
+            print_report(args, report, expectation)
+    # Pruned subtrees may contain further links, just like unselected ones.
+    complete = not is_selective(args) and not args.prune
+    for report in args.inode_index.final_reports(complete=complete):
+        print_report(args, report)
+    args.report_sink.close()
+    for rule in args.ignore_rules.unused_rules():
+        print(f"Warning: Ignore rule '{rule.description}' never matched anything", file=sys.stderr)
+
+
+def broadcast(iterable, count):
+    """
+    Returns 'count' iterators that each yield all items of 'iterable', which is read only once,
+    by a background thread. Each iterator is meant to be consumed by its own thread; the fastest
+    one is at most BROADCAST_QUEUE_SIZE items ahead of the slowest one.
+    """
+    queues = [queue.Queue(BROADCAST_QUEUE_SIZE) for _ in range(count)]
+    abandoned = [False] * count
+    end = object()
+    failure = []
+
+    def feed():
+        try:
+            for item in iterable:
+                for i, item_queue in enumerate(queues):
+                    if not abandoned[i]:
+                        item_queue.put(item)
+        except BaseException as e:
+            failure.append(e)
+        for i, item_queue in enumerate(queues):
+            if not abandoned[i]:
+                item_queue.put(end)
+
+    def consume(i):
+        try:
+            while True:
+                item = queues[i].get()
+                if item is end:
+                    break
+                yield item
+            if failure:
+                raise failure[0]
+        finally:
+            # Don't let the feeder block on a queue that nobody reads anymore.
+            abandoned[i] = True
+            while not queues[i].empty():
+                queues[i].get_nowait()
+
+    threading.Thread(target=feed, daemon=True).start()
+    return [consume(i) for i in range(count)]
+
+
+def run_roots(args, expectations):
+    """
+    Checks all --destdir roots concurrently against the same expectations, which are read only
+    once. Returns a dict that maps each root to the SummarySink of its reports.
+    """
+    all_root_args = []
+    summaries = dict()
+    for destdir in args.destdirs:
+        # Everything that check_expectation keeps on 'args' is per root, except the caches.
+        root_args = copy.copy(args)
+        root_args.destdir = destdir
+        # The names are needed to tell which findings appear in every root.
+        summaries[destdir] = report_sink.SummarySink(args.summary_top, keep_names=True)
+        root_args.report_sink = report_sink.TeeSink(report_sinks(args, root=destdir) + [summaries[destdir]])
+        all_root_args.append(root_args)
+    streams = broadcast(expectations, len(all_root_args))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(all_root_args)) as executor:
+        futures = [
+            executor.submit(run_expectations, root_args, stream) for root_args, stream in zip(all_root_args, streams)
+        ]
+        for future in futures:
+            future.result()
+    return summaries
+
+
+def print_roots_summary(summaries):
+    """
+    Findings that appear in every root are more likely outdated expectations than drift.
+    """
+    print(f"Summary for {len(summaries)} roots:", file=sys.stderr)
+    for root, summary in summaries.items():
+        details = ", ".join(f"{key}: {count}" for key, count in sorted(summary.keys.items()))
+        print(f"  {root}: {summary.findings} findings{f' ({details})' if details else ''}", file=sys.stderr)
+    everywhere = set.intersection(*[summary.names for summary in summaries.values()])
+    if everywhere:
+        print(
+            f"  {len(everywhere)} paths have findings in every root (e.g. {min(everywhere)}), maybe the expectations are outdated.",
+            file=sys.stderr,
+        )
+
+
+def is_selective(args):
+    return bool(args.package or args.path_prefix)
+
+
+def package_matches(package, selected_packages):
+    # 'bash' matches 'bash:amd64', 'bash:i386', etc.
+    return any(package == selected or package.startswith(selected + ":") for selected in selected_packages)
+
+
+def is_selected(args, expectation):
+    """
+    Whether the expectation belongs to any of the selected packages or path prefixes.
+    """
+    if not is_selective(args):
+        return True
+    parts = expectation_io.name_to_parts(expectation["name"])
+    for prefix in args.path_prefix:
+        prefix = expectation_io.name_to_parts(prefix)
+        if parts[: len(prefix)] == prefix:
+            return True
+    return any(package_matches(package, args.package) for package in expectation.get("packages", []))
+
+
+def select_expectations(args, expectations):
+    """
+    Returns only the expectations that belong to any of the selected packages or path prefixes.
+    The compact format can jump right to them using its indexes; JSON needs to be filtered.
+    """
+    if not is_selective(args):
+        return expectations
+    if isinstance(expectations, expectation_store.ExpectationStore):
+        prefixes = [expectation_io.name_to_parts(prefix) for prefix in args.path_prefix]
+        return expectations.select(packages=args.package, prefixes=prefixes)
+    print("Warning: Selecting from JSON means reading all of it. Consider convert_expectations.py.", file=sys.stderr)
+    return (expectation for expectation in expectations if is_selected(args, expectation))
+
+
+class ExpectationIndex:
+    """
+    Finds the expectations for single paths and entire subtrees, for --watch. The compact
+    format has indexes for that; JSON is kept in memory (as compact records), sorted, and
+    searched by bisection.
+    """
+
+    def __init__(self, expectations):
+        if isinstance(expectations, expectation_store.ExpectationStore):
+            self.store = expectations
+            self.expectations = None
+        else:
+            self.store = None
+            self.expectations = sorted(
+                map(expectation_record.compact, expectations), key=expectation_io.expectation_sort_key
+            )
+
+    def __iter__(self):
+        return iter(self.store if self.store is not None else self.expectations)
+
+    def find(self, parts, subtree=False):
+        """
+        Returns the expectations for the given path, and with subtree=True also for everything
+        below it, in the usual order.
+        """
+        if self.store is not None:
+            if subtree:
+                return list(self.store.select(prefixes=[parts]))
+            expectation = self.store.lookup(expectation_io.parts_to_key(parts))
+            return [] if expectation is None else [expectation]
+        key = expectation_io.parts_sort_key(parts)
+        # The subtree starts with the first key that extends the directory's components, and
+        # ends with the directory itself.
+        start = bisect.bisect_left(
+            self.expectations, key[:-1] if subtree else key, key=expectation_io.expectation_sort_key
+        )
+        end = bisect.bisect_right(self.expectations, key, key=expectation_io.expectation_sort_key)
+        return self.expectations[start:end]
+
+
+def is_watched(args, expectation):
+    return is_selected(args, expectation) and not args.ignore_rules.is_pruned(
+        expectation_io.name_to_parts(expectation["name"])
+    )
+
+
+def schedule_change(pending, parts, subtree, due):
+    old = pending.get(parts)
+    if old is not None:
+        # Debouncing: Further changes are folded into the already scheduled check.
+        due, subtree = old[0], old[1] or subtree
+    pending[parts] = (due, subtree)
+
+
+def coalesce_pending(pending, limit):
+    """
+    Replaces pending paths by a check of the entire subtree of their ancestors, one level
+    at a time, until at most 'limit' remain.
+    """
+    depth = max(len(parts) for parts in pending)
+    while len(pending) > limit and depth > 0:
+        depth -= 1
+        coalesced = dict()
+        for parts, (due, subtree) in pending.items():
+            if len(parts) > depth:
+                parts, subtree = parts[:depth], True
+            old = coalesced.get(parts)
+            if old is not None:
+                due, subtree = min(due, old[0]), subtree or old[1]
+            coalesced[parts] = (due, subtree)
+        pending = coalesced
+    return pending
+
+
+def recheck(args, index, watcher, changes, outstanding):
+    """
+    Checks the expectations for all changed paths again, and reports only what is new:
+    Findings that changed, and paths whose findings are gone ("resolved").
+    """
+    expectations = []
+    for parts, subtree in changes:
+        expectations.extend(e for e in index.find(parts, subtree) if is_watched(args, e))
+    expectations.sort(key=expectation_io.expectation_sort_key)
+    # Overlapping subtrees would check the same path twice.
+    expectations = [e for i, e in enumerate(expectations) if i == 0 or e != expectations[i - 1]]
+    # Only used to resolve hardlinks here; unexpected hardlinks are reported by the first pass only.
+    args.inode_index = InodeIndex()
+    for expectation, report in resolve_links(args, check_expectations(args, expectations)):
+        name = expectation["name"]
+        if report is not None:
+            if outstanding.get(name) != report:
+                outstanding[name] = report
+                print_report(args, report, expectation)
+        elif outstanding.pop(name, None) is not None:
+            print_report(args, dict(name=name, resolved=True), expectation)
+        if watcher.per_directory and expectation["filetype"] == "dir":
+            # Directories may have been replaced or created, which needs a new watch.
+            watcher.watch_dir(expectation_io.name_to_parts(name))
+
+
+def watch(args, index, watcher, outstanding):
+    """
+    Runs forever after the first pass, and checks changed paths (and their parent directories)
+    again, after waiting args.watch_debounce seconds for further changes.
+    'outstanding' maps the name of each path with findings to its latest report.
+    """
+    # Maps parts to (due, subtree)
+    pending = dict()
+    print(f"Watching {args.destdir} for changes", file=sys.stderr)
+    while True:
+        timeout = None
+        if pending:
+            timeout = max(0, min(due for due, _subtree in pending.values()) - time.monotonic())
+        ready, _, _ = select.select([watcher], [], [], timeout)
+        now = time.monotonic()
+        if ready:
+            for parts, subtree in watcher.read_events():
+                schedule_change(pending, parts, subtree, now + args.watch_debounce)
+                if parts:
+                    # The parent directory may have gained or lost children.
+                    schedule_change(pending, parts[:-1], False, now + args.watch_debounce)
+            if len(pending) > args.watch_queue:
+                pending = coalesce_pending(pending, args.watch_queue)
+                print(
+                    f"Warning: Too many changes at once, checking {len(pending)} subtree(s) as a whole instead",
+                    file=sys.stderr,
+                )
+        changes = [(parts, subtree) for parts, (due, subtree) in pending.items() if due <= now]
+        for parts, _subtree in changes:
+            del pending[parts]
+        if changes:
+            recheck(args, index, watcher, changes, outstanding)
+
+
+def progress_fraction(args, expectations):
+    """
+    Returns a callable that estimates how much of the work is done, or None if there's no way to tell.
+    """
+    if isinstance(expectations, expectation_io.JsonExpectations):
+        return expectations.fraction_read
+    if isinstance(expectations, expectation_store.ExpectationStore) and not is_selective(args):
+        total = len(expectations) * len(args.destdirs)
+        return lambda: args.progress.done / total if total else None
+    return None
 
 
 def run(args):
-    with open(args.json_filename, "r") as fp:
-        expectations = json.load(fp)
-    _reports = run_expectations(args, expectations)
-    # TODO: Do something more reasonable with the reports?
+    destdirs = [destdir if destdir.endswith("/") else destdir + "/" for destdir in args.destdirs or ["/"]]
+    args.destdirs = list(dict.fromkeys(destdirs))
+    args.destdir = args.destdirs[0]
+    expectations = expectation_io.open_expectations(args.json_filename)
+    if args.watch:
+        # Watching needs to look up changed paths later on, so JSON has to stay in memory.
+        index = ExpectationIndex(expectations)
+        expectations = index.store if index.store is not None else index.expectations
+        # Start watching before the first pass, so that no change can slip through in between.
+        watcher = fs_watch.open_watcher(args.destdir)
+        if watcher.per_directory:
+            args.ignore_rules = build_ignore_rules(args)
+            for expectation in index:
+                if expectation["filetype"] == "dir" and is_watched(args, expectation):
+                    watcher.watch_dir(expectation_io.name_to_parts(expectation["name"]))
+    args.stats = instrumentation.Stats("check_expect", args.stats_top)
+    args.progress = instrumentation.Progress(
+        args.stats, "files", progress_fraction(args, expectations), enabled=args.show_progress
+    )
+    expectations = args.stats.timed(select_expectations(args, expectations), "load")
+    if args.hash_cache_filename is not None:
+        args.hash_cache = HashCache(args.hash_cache_filename, args.verify_cache)
+    else:
+        args.hash_cache = None
+    args.hash_memo = HashMemo(shared_devices(args.destdirs) if len(args.destdirs) > 1 else frozenset())
+    if len(args.destdirs) > 1:
+        summaries = run_roots(args, expectations)
+        print_roots_summary(summaries)
+    else:
+        summaries = {args.destdir: report_sink.SummarySink(args.summary_top)}
+        sinks = report_sinks(args) + [summaries[args.destdir]]
+        if args.watch:
+            latest = report_sink.LatestReportSink()
+            sinks.append(latest)
+        args.report_sink = report_sink.TeeSink(sinks)
+        run_expectations(args, expectations)
+    args.progress.finish()
+    if args.print_summary or args.summary_json is not None:
+        summary = report_sink.SummarySink(args.summary_top)
+        for root_summary in summaries.values():
+            summary.merge(root_summary)
+        if args.print_summary:
+            summary.print_summary()
+        if args.summary_json is not None:
+            summary.write_json(args.summary_json)
+    if args.hash_cache is not None:
+        # Unless we hashed everything, some valid entries simply weren't needed this time.
+        args.hash_cache.save(compact=not is_selective(args) and args.level == "full")
+    instrumentation.report(args.stats, args)
+    if args.watch:
+        # From now on, each report should show up right away.
+        args.report_sink = report_sink.TeeSink(report_sinks(args, flush=True))
+        try:
+            # The hardlink reports from the end of the first pass are not re-evaluated while watching.
+            watch(args, index, watcher, latest.reports)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
 
 
 def build_parser():
@@ -247,11 +1386,125 @@ def build_parser():
     parser.add_argument(
         "json_filename",
         metavar="total_or_deb.json",
+        help="Expectations, either as JSON or as converted by convert_expectations.py",
     )
     parser.add_argument(
         "--destdir",
-        default="/",
-        help="Root of the filesystem under test. (default: '/')",
+        dest="destdirs",
+        action="append",
+        help="Root of the filesystem under test. Can be specified multiple times to check several roots (e.g. mounted images) concurrently against the same expectations; each report then has a 'root' key. (default: '/')",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of files to check in parallel. Reports are still emitted in order. (default: 1)",
+    )
+    parser.add_argument(
+        "--package",
+        metavar="NAME[:ARCH]",
+        action="append",
+        default=[],
+        help="Only check the expectations of this package. Can be specified multiple times, and combined with --path-prefix. (default: check everything)",
+    )
+    parser.add_argument(
+        "--path-prefix",
+        metavar="PREFIX",
+        action="append",
+        default=[],
+        help="Only check this path and everything below it, e.g. '/usr/lib/systemd'. Can be specified multiple times, and combined with --package. (default: check everything)",
+    )
+    parser.add_argument(
+        "--walk",
+        action="store_true",
+        help="Walk --destdir alongside the expectations, scanning each directory only once and stat'ing relative to it. Fastest with expectations from merge_expectations.py. (default: stat each full path)",
+    )
+    parser.add_argument(
+        "--level",
+        choices=["meta", "sampled", "full"],
+        default="full",
+        help="How thoroughly to check file contents: 'meta' never reads any file, and only checks metadata, xattrs and symlinks. 'sampled' additionally hashes a different fraction of the files in each slot (see --sample-fraction). 'full' hashes everything. (default: full)",
+    )
+    parser.add_argument(
+        "--sample-fraction",
+        metavar="N",
+        type=int,
+        default=7,
+        help="With --level sampled: Hash 1/N of the files, so that everything is covered after N consecutive slots. (default: 7)",
+    )
+    parser.add_argument(
+        "--sample-slot",
+        metavar="K",
+        type=int,
+        default=int(time.time() // 86400),
+        help="With --level sampled: Which fraction of files to hash. (default: days since 1970, so daily runs cover everything)",
+    )
+    parser.add_argument(
+        "--io-order",
+        choices=["name", "inode", "extent"],
+        default="name",
+        help="Order in which files are read. 'inode' and 'extent' (physical location, where FIEMAP is supported) reduce seeking on spinning disks. Reports still come out in name order. (default: name)",
+    )
+    parser.add_argument(
+        "--hash-cache",
+        dest="hash_cache_filename",
+        metavar="CACHE.json",
+        help="Reuse sha256 digests of files whose (dev, inode, size, mtime, ctime) did not change since the last run. (default: no cache)",
+    )
+    parser.add_argument(
+        "--verify-cache",
+        action="store_true",
+        help="Ignore the contents of the hash cache and re-hash everything, but still update the cache. (default: trust the cache)",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="After checking everything, keep running, and check changed paths again as soon as they change. Uses fanotify if permitted, otherwise inotify. (default: check once and exit)",
+    )
+    parser.add_argument(
+        "--watch-debounce",
+        type=float,
+        metavar="SECONDS",
+        default=1.0,
+        help="With --watch, wait this long after a change before checking, so that bursts of changes are checked only once. (default: 1.0)",
+    )
+    parser.add_argument(
+        "--watch-queue",
+        type=int,
+        metavar="N",
+        default=10000,
+        help="With --watch, if more than N paths are waiting to be checked, check their common subtrees instead. (default: 10000)",
+    )
+    parser.add_argument(
+        "--summary",
+        dest="print_summary",
+        action="store_true",
+        help="At the end, print the number of findings by kind, by top-level directory and by package to stderr. (default: don't)",
+    )
+    parser.add_argument(
+        "--summary-json",
+        metavar="FILENAME",
+        help="At the end, write the same summary as JSON to this file. (default: don't)",
+    )
+    parser.add_argument(
+        "--summary-top",
+        type=int,
+        metavar="N",
+        default=report_sink.DEFAULT_TOP_N,
+        help=f"How many of the top-level directories and packages with the most findings to list in the summary. (default: {report_sink.DEFAULT_TOP_N})",
+    )
+    parser.add_argument(
+        "--no-reports",
+        dest="show_reports",
+        action="store_false",
+        help="Don't print each report to stdout, e.g. if only the summary is of interest. (default: print them)",
+    )
+    instrumentation.add_arguments(parser)
+    parser.add_argument(
+        "--fail-fast",
+        action="store_true",
+        help="For files with per-chunk digests (see deb2fsexpect.py --chunk-threshold), stop reading at the first differing chunk. The actual sha256 is then reported as null. (default: read the whole file and report all differing byte ranges)",
     )
     parser.add_argument(
         "--ignore-mtime",
@@ -273,9 +1526,40 @@ def build_parser():
               (default: empty list)",
         default=[],
     )
+    parser.add_argument(
+        "--prune",
+        metavar="PATTERN",
+        action="append",
+        default=[],
+        help="Don't check anything at or below matching paths, and don't report them as extraneous either. Patterns can use '*', '?', '[...]' within a component, and '**' for any number of components. Can be specified multiple times. Example: --prune /var/log (default: empty list)",
+    )
+    parser.add_argument(
+        "--ignore-extraneous",
+        metavar="PATTERN",
+        action="append",
+        default=[],
+        help="Don't report matching paths as extraneous children. Can be specified multiple times. Example: --ignore-extraneous '/usr/lib/python3*/**/*.pyc' (default: empty list)",
+    )
+    parser.add_argument(
+        "--ignore-attr",
+        metavar="ATTRIBUTE:PATTERN",
+        action="append",
+        default=[],
+        help=f"Don't check the attribute for matching paths. Attributes: {', '.join(IGNORABLE_ATTRIBUTES)}. Can be specified multiple times. Example: --ignore-attr 'sha256:/etc/**' (default: empty list)",
+    )
     return parser
 
 
 if __name__ == "__main__":
-    args = build_parser().parse_args()
+    parser = build_parser()
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error(f"--jobs must be at least 1, got {args.jobs}")
+    if args.watch and args.destdirs and len(args.destdirs) > 1:
+        parser.error("--watch supports only a single --destdir")
+    if args.sample_fraction < 1:
+        parser.error(f"--sample-fraction must be at least 1, got {args.sample_fraction}")
+    for attribute_and_pattern in args.ignore_attr:
+        if attribute_and_pattern.split(":", 1)[0] not in IGNORABLE_ATTRIBUTES or ":" not in attribute_and_pattern:
+            parser.error(f"--ignore-attr needs ATTRIBUTE:PATTERN with one of {', '.join(IGNORABLE_ATTRIBUTES)}, got {attribute_and_pattern!r}")
     run(args)
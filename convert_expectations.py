@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+import argparse
+import expectation_io
+import sys
+
+
+def run(args):
+    expectations = expectation_io.open_expectations(args.input_filename)
+    writer = expectation_io.create_expectation_writer(args.output_filename)
+    for expectation in expectations:
+        writer.write(expectation)
+    writer.close()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description=f"Converts expectations between JSON and the compact indexed format. Output files ending in '{expectation_io.STORE_SUFFIX}' use the compact format, everything else is written as JSON."
+    )
+    parser.add_argument(
+        "input_filename",
+        metavar="INPUT.json_or_sqlite",
+    )
+    parser.add_argument(
+        "output_filename",
+        metavar="OUTPUT.json_or_sqlite",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    if args.input_filename == args.output_filename:
+        print("Input and output must be different files, aborting.", file=sys.stderr)
+        exit(1)
+    run(args)
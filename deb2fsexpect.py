@@ -2,10 +2,21 @@
 
 from debian import debfile
 import argparse
+import concurrent.futures
+import expectation_io
+import expectation_store
 import hashlib
-import json
+import instrumentation
+import os
 import sys
 import tarfile
+import time
+
+try:
+    import zstandard
+except ModuleNotFoundError:
+    # Only needed for streaming zstd-compressed .debs; python-debian is used as a fallback.
+    zstandard = None
 
 
 if getattr(hashlib, "file_digest", None) is None:
@@ -16,6 +27,15 @@ if getattr(hashlib, "file_digest", None) is None:
     exit(2)
 
 
+# Bump this whenever the output for the same .deb and flags changes, to invalidate the batch cache.
+CACHE_FORMAT_VERSION = 2
+
+AR_MAGIC = b"!<arch>\n"
+AR_HEADER_SIZE = 60
+# Big enough for fast reads, small enough to not matter for memory usage.
+STREAM_BUFFER_SIZE = 1024 * 1024
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
 USR_MERGE_ROOT_DIRS = [
     "bin",
     "lib",
@@ -60,8 +80,79 @@ def resolve_name(name_in_tar, args):
     return name_in_tar, False
 
 
-def extract_info(debfile_object, args):
+class BoundedReader:
+    """
+    Read-only file object for the next 'size' bytes of 'fp', e.g. a single member of an ar archive.
+    """
+
+    def __init__(self, fp, size):
+        self.fp = fp
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fp.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+def open_data_tar_stream(deb_fp):
+    """
+    Finds the data.tar member in the .deb and returns it as a tarfile in stream mode, which
+    decompresses incrementally and never seeks backwards, so memory usage does not depend on the
+    size of the package. Returns None if the compression is not supported here.
+    """
+    if deb_fp.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise ValueError("Not an ar archive")
+    while True:
+        header = deb_fp.read(AR_HEADER_SIZE)
+        if len(header) < AR_HEADER_SIZE:
+            raise ValueError("No data.tar member found")
+        name = header[0:16].decode().rstrip(" /")
+        size = int(header[48:58].decode())
+        if name.startswith("data.tar"):
+            break
+        # Members are padded to an even size.
+        deb_fp.seek(size + size % 2, 1)
+    member_fp = BoundedReader(deb_fp, size)
+    if name == "data.tar.zst":
+        if zstandard is None:
+            return None
+        decompressed_fp = zstandard.ZstdDecompressor().stream_reader(member_fp, read_size=STREAM_BUFFER_SIZE)
+        return tarfile.open(fileobj=decompressed_fp, mode="r|", bufsize=STREAM_BUFFER_SIZE)
+    if name in ["data.tar", "data.tar.gz", "data.tar.xz", "data.tar.bz2"]:
+        return tarfile.open(fileobj=member_fp, mode="r|*", bufsize=STREAM_BUFFER_SIZE)
+    return None
+
+
+def digest_chunks(fp, chunk_size):
+    """
+    Returns the sha256 of the entire file, and the list of sha256 digests of each chunk of
+    chunk_size bytes (the last one may be shorter). Everything is computed in a single pass.
+    """
+    digest = hashlib.sha256()
+    chunk_digests = []
+    while chunk := fp.read(chunk_size):
+        digest.update(chunk)
+        chunk_digests.append(hashlib.sha256(chunk).hexdigest())
+    return digest.hexdigest(), chunk_digests
+
+
+def package_name(debfile_object):
+    """
+    Returns e.g. 'bash:amd64' or 'tzdata:all'. The architecture is necessary to distinguish multiarch packages.
+    """
+    debcontrol = debfile_object.debcontrol()
+    return f"{debcontrol['Package']}:{debcontrol['Architecture']}"
+
+
+def extract_info(debfile_object, args, datatarfile=None):
     expectations = []
+    package = package_name(debfile_object)
     controlfile = debfile_object.control
     # TODO: Do something with controlfile.scripts?
     # TODO: Parse scripts for calls to dpkg-divert
@@ -71,15 +162,29 @@ def extract_info(debfile_object, args):
     scripts = controlfile.scripts()
     if scripts:
         print(f"ignoring {len(scripts)} scripts: {scripts.keys()}")
-    datatarfile = debfile_object.data.tgz()
+    if datatarfile is None:
+        datatarfile = debfile_object.data.tgz()
     # Using the datatarfile as an iterator *might* interfere with the functions "getmembers'.
-    for info_member in datatarfile:
+    # In stream mode, it's the only thing that works anyway.
+    for info_member in args.stats.timed(datatarfile, "tar"):
+        member_chunks = None
         if info_member.isreg():
+            started = time.perf_counter()
             info_content_fp = datatarfile.extractfile(info_member)
             assert info_content_fp is not None, info_member
-            member_sha256 = hashlib.file_digest(info_content_fp, "sha256").hexdigest()
+            if args.chunk_threshold is not None and info_member.size > args.chunk_threshold:
+                member_sha256, chunk_digests = digest_chunks(info_content_fp, args.chunk_size)
+                member_chunks = {"size": args.chunk_size, "sha256": chunk_digests}
+            else:
+                member_sha256 = hashlib.file_digest(info_content_fp, "sha256").hexdigest()
+            # Includes decompressing the member, which happens while reading it.
+            elapsed = time.perf_counter() - started
+            args.stats.add_time("hash", elapsed)
+            args.stats.record_path(f"{package} {info_member.name}", elapsed)
+            args.stats.count("bytes_hashed", info_member.size)
         else:
             member_sha256 = None
+        args.stats.count("members")
         if info_member.isdev():
             dev_inode = (info_member.devmajor, info_member.devminor)
         else:
@@ -102,6 +207,7 @@ def extract_info(debfile_object, args):
                 "sha256": None,
                 "dev_inode": None,
                 "children": None,
+                "packages": [package],
             }
             expectations.append(injected_expectation)
         filetype = tarinfo_type_to_string(info_member)
@@ -122,6 +228,7 @@ def extract_info(debfile_object, args):
             "sha256": member_sha256,
             "dev_inode": dev_inode,
             "children": None,
+            "packages": [package],
         }
         if args.expect_run_merged and actual_name in ["./var/lock", "./var/run"]:
             # The destination is in fact also part of the base-files package, so we must not create a new entry for that.
@@ -133,6 +240,9 @@ def extract_info(debfile_object, args):
             else:
                 raise AssertionError(actual_name)
             new_expectation["mode"] = 0o777
+        if member_chunks is not None and new_expectation["filetype"] == "reg":
+            # Only present for large files, so that check_expect.py can tell where they differ.
+            new_expectation["chunks"] = member_chunks
         if info_member.pax_headers:
             print(
                 f"Warning: Non-empty PAX-headers for file {info_member.name}: {info_member.pax_headers}",
@@ -140,14 +250,160 @@ def extract_info(debfile_object, args):
             )
         expectations.append(new_expectation)
 
+    # merge_expectations.py relies on this order:
+    expectations.sort(key=expectation_io.expectation_sort_key)
     return expectations
 
 
+def convert(deb_filename, json_filename, args):
+    debfile_object = debfile.DebFile(deb_filename)
+    started = time.monotonic()
+    with open(deb_filename, "rb") as deb_fp:
+        datatarfile = open_data_tar_stream(deb_fp)
+        if datatarfile is None:
+            print(f"Warning: Can't stream data.tar of {deb_filename}, falling back to python-debian", file=sys.stderr)
+        expectations = extract_info(debfile_object, args, datatarfile)
+    elapsed = time.monotonic() - started
+    total_size = sum(e["size"] for e in expectations if e["filetype"] == "reg")
+    print(
+        f"{deb_filename}: {len(expectations)} entries, {total_size / 2**20:.1f} MiB in {elapsed:.2f}s ({total_size / 2**20 / max(elapsed, 1e-6):.1f} MiB/s)",
+        file=sys.stderr,
+    )
+    with args.stats.phase("output"):
+        writer = expectation_io.create_expectation_writer(json_filename)
+        for expectation in expectations:
+            writer.write(expectation)
+        writer.close()
+
+
 def run(args):
-    debfile_object = debfile.DebFile(args.deb_filename)
-    expectations = extract_info(debfile_object, args)
-    with open(args.json_filename, "w") as fp:
-        json.dump(expectations, fp)
+    args.stats = instrumentation.Stats("deb2fsexpect", args.stats_top)
+    convert(args.deb_filename, args.json_filename, args)
+    instrumentation.report(args.stats, args)
+
+
+def cache_filename(args, deb_sha256):
+    """
+    The cache is content-addressed: The key depends only on the content of the .deb, on all
+    flags that change the output, and on the output format.
+    """
+    flags = "".join(
+        [
+            "r" if args.expect_run_merged else "-",
+            "u" if args.expect_usr_merged else "-",
+            "" if args.chunk_threshold is None else f"c{args.chunk_threshold}-{args.chunk_size}",
+        ]
+    )
+    if args.output_suffix.endswith(expectation_io.STORE_SUFFIX):
+        # Stores of an older format can't be read anymore.
+        flags += f"s{expectation_store.STORE_FORMAT_VERSION}"
+    return os.path.join(args.cache_dir, f"{deb_sha256}.v{CACHE_FORMAT_VERSION}{flags}{args.output_suffix}")
+
+
+def place_file(source_filename, destination_filename):
+    # Hardlink if possible, since cache entries are never modified, only replaced.
+    temp_filename = destination_filename + ".tmp"
+    if os.path.lexists(temp_filename):
+        os.remove(temp_filename)
+    try:
+        os.link(source_filename, temp_filename)
+    except OSError:
+        with open(source_filename, "rb") as src, open(temp_filename, "wb") as dst:
+            while chunk := src.read(1024 * 1024):
+                dst.write(chunk)
+    os.replace(temp_filename, destination_filename)
+
+
+def convert_cached(deb_filename, json_filename, args):
+    """
+    Runs in a worker process. Returns True if the result came from the cache, and the statistics (as a dict).
+    """
+    # Each worker process has its own copy of args, so this is never shared.
+    args.stats = instrumentation.Stats("deb2fsexpect", args.stats_top)
+    if args.cache_dir is None:
+        convert(deb_filename, json_filename, args)
+        return False, args.stats.to_dict()
+    with args.stats.phase("cache"):
+        with open(deb_filename, "rb") as fp:
+            deb_sha256 = hashlib.file_digest(fp, "sha256").hexdigest()
+        cached_filename = cache_filename(args, deb_sha256)
+        is_cached = os.path.exists(cached_filename)
+        if is_cached and (not os.path.exists(json_filename) or not os.path.samefile(cached_filename, json_filename)):
+            place_file(cached_filename, json_filename)
+    if is_cached:
+        return True, args.stats.to_dict()
+    temp_filename = f"{cached_filename}.{os.getpid()}.tmp{args.output_suffix}"
+    convert(deb_filename, temp_filename, args)
+    os.replace(temp_filename, cached_filename)
+    place_file(cached_filename, json_filename)
+    return False, args.stats.to_dict()
+
+
+def find_batch_debs(batch_paths):
+    deb_filenames = []
+    for path in batch_paths:
+        if os.path.isdir(path):
+            deb_filenames.extend(
+                os.path.join(path, entry) for entry in sorted(os.listdir(path)) if entry.endswith(".deb")
+            )
+        else:
+            deb_filenames.append(path)
+    return deb_filenames
+
+
+def batch_output_filename(args, deb_filename):
+    if args.output_dir is None:
+        return deb_filename + args.output_suffix
+    return os.path.join(args.output_dir, os.path.basename(deb_filename) + args.output_suffix)
+
+
+def run_batch(args):
+    deb_filenames = find_batch_debs(args.batch)
+    if args.cache_dir is not None:
+        os.makedirs(args.cache_dir, exist_ok=True)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+    cached = 0
+    errors = 0
+    # Not on args, since that is sent to the worker processes.
+    stats = instrumentation.Stats("deb2fsexpect", args.stats_top)
+    progress = instrumentation.Progress(
+        stats, "debs", lambda: progress.done / len(deb_filenames), enabled=args.show_progress
+    )
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [
+            executor.submit(convert_cached, deb_filename, batch_output_filename(args, deb_filename), args)
+            for deb_filename in deb_filenames
+        ]
+        for deb_filename, future in zip(deb_filenames, futures):
+            try:
+                was_cached, deb_stats = future.result()
+            except Exception as e:
+                print(f"ERROR: Failed to process {deb_filename}: {e!r}", file=sys.stderr)
+                errors += 1
+                continue
+            finally:
+                progress.update()
+            cached += was_cached
+            stats.merge(deb_stats)
+            # The slowest members of each .deb are already in there, but whole .debs are interesting, too.
+            stats.record_path(deb_filename, deb_stats["wall_seconds"])
+            stats.count("debs")
+            if not progress.enabled:
+                print(f"{'Cached' if was_cached else 'Processed'} {deb_filename}", file=sys.stderr)
+    progress.finish()
+    instrumentation.report(stats, args)
+    print(
+        f"Done with {len(deb_filenames)} debs: {len(deb_filenames) - cached - errors} processed, {cached} from cache, {errors} failed.",
+        file=sys.stderr,
+    )
+    if errors:
+        exit(1)
+
+
+def default_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "sysexpect", "debs")
 
 
 def build_parser():
@@ -155,10 +411,47 @@ def build_parser():
     parser.add_argument(
         "deb_filename",
         metavar="some/path/to/package.deb",
+        nargs="?",
     )
     parser.add_argument(
         "json_filename",
         metavar="other/path/to/output.json",
+        nargs="?",
+        help=f"If it ends in '{expectation_io.STORE_SUFFIX}', the compact indexed format is used instead of JSON.",
+    )
+    parser.add_argument(
+        "--batch",
+        metavar="DEB_OR_DIR",
+        action="append",
+        help="Instead of a single .deb, process these .debs and all .debs in these directories. Can be specified multiple times. (default: single mode)",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=os.cpu_count(),
+        help="Batch mode only: Number of .debs to process in parallel. (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--output-dir",
+        help="Batch mode only: Where to write the results. (default: next to each .deb)",
+    )
+    parser.add_argument(
+        "--output-suffix",
+        default=".json",
+        help=f"Batch mode only: Appended to the name of each .deb to get the output filename. Use '{expectation_io.STORE_SUFFIX}' for the compact format. (default: '.json')",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=default_cache_dir(),
+        help="Batch mode only: Reuse results for .debs with the same sha256 and flags. (default: $XDG_CACHE_HOME/sysexpect/debs)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="cache_dir",
+        action="store_const",
+        const=None,
+        help="Batch mode only: Don't use the cache at all.",
     )
     parser.add_argument(
         "--expect-run-merged",
@@ -170,9 +463,33 @@ def build_parser():
         action="store_true",
         help="Assume that bin,lib{,32,64,x32},sbin are symlinks into usr/... (default: false)",
     )
+    parser.add_argument(
+        "--chunk-threshold",
+        type=int,
+        metavar="BYTES",
+        help="For regular files larger than this, also store the sha256 of each chunk, so that check_expect.py can stop at the first differing chunk and report which byte ranges differ. (default: never)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        metavar="BYTES",
+        default=DEFAULT_CHUNK_SIZE,
+        help=f"Size of the chunks for --chunk-threshold. (default: {DEFAULT_CHUNK_SIZE})",
+    )
+    instrumentation.add_arguments(parser)
     return parser
 
 
 if __name__ == "__main__":
-    args = build_parser().parse_args()
-    run(args)
+    parser = build_parser()
+    args = parser.parse_args()
+    if args.chunk_size <= 0:
+        parser.error("--chunk-size must be positive")
+    if args.batch:
+        if args.deb_filename is not None:
+            parser.error("--batch does not take positional arguments")
+        run_batch(args)
+    else:
+        if args.json_filename is None:
+            parser.error("need both a .deb and an output filename (or use --batch)")
+        run(args)
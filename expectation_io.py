@@ -0,0 +1,208 @@
+"""
+Helpers shared by deb2fsexpect.py, merge_expectations.py, and check_expect.py for reading
+and writing lists of expectations.
+
+Expectations can be stored either as a plain JSON array, or in the compact, indexed format
+of expectation_store.py. Files ending in STORE_SUFFIX are written in the latter format;
+when reading, the format is detected automatically.
+"""
+
+import codecs
+import json
+import os
+
+
+STORE_SUFFIX = ".sqlite"
+READ_CHUNK_SIZE = 16 * 1024
+JSON_WHITESPACE = " \t\n\r"
+
+
+def name_to_parts(name):
+    """
+    Splits a name like './usr/bin/ls' into its components ('usr', 'bin', 'ls').
+    The root directory ('.' or './') has no components at all.
+    """
+    return tuple(part for part in name.split("/") if part and part != ".")
+
+
+def parts_to_key(parts):
+    """
+    The key under which a path is reported in messages, e.g. 'usr/bin/ls', or '.' for the root.
+    """
+    return "/".join(parts) or "."
+
+
+def parts_sort_key(parts):
+    """
+    Sort key for expectations: Siblings are sorted by name, and each directory comes right
+    *after* all of its contents. This way, the children of a directory are all known by the
+    time the directory itself is reached.
+    """
+    # The prefix "0" makes each component sort before the terminator "1".
+    return tuple("0" + part for part in parts) + ("1",)
+
+
+def expectation_sort_key(expectation):
+    return parts_sort_key(name_to_parts(expectation["name"]))
+
+
+class ReopeningReader:
+    """
+    Minimal read-only text file that only keeps the underlying file open while reading a
+    chunk. This allows streaming thousands of files at the same time without running into
+    the limit of open file descriptors.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+
+    def read(self, size):
+        text = ""
+        while not text:
+            with open(self.filename, "rb") as fp:
+                fp.seek(self.offset)
+                data = fp.read(size)
+            self.offset += len(data)
+            text = self.decoder.decode(data, final=not data)
+            if not data:
+                break
+        return text
+
+
+def iter_json_array(fp):
+    """
+    Yields the elements of the JSON array in the text file 'fp' one by one, without ever
+    loading the entire file. The elements must be JSON objects or arrays.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    state = "start"  # One of "start", "first", "next", "value"
+    while True:
+        while True:
+            while position < len(buffer) and buffer[position] in JSON_WHITESPACE:
+                position += 1
+            if position < len(buffer):
+                break
+            chunk = fp.read(READ_CHUNK_SIZE)
+            if not chunk:
+                raise ValueError("Unexpected end of file in JSON array")
+            buffer = chunk
+            position = 0
+        char = buffer[position]
+        if state == "start":
+            if char != "[":
+                raise ValueError(f"Expected JSON array, found {char!r} instead")
+            position += 1
+            state = "first"
+        elif char == "]" and state in ("first", "next"):
+            return
+        elif state == "next":
+            if char != ",":
+                raise ValueError(f"Expected ',' or ']' in JSON array, found {char!r} instead")
+            position += 1
+            state = "value"
+        else:
+            while True:
+                try:
+                    value, position = decoder.raw_decode(buffer, position)
+                    break
+                except json.JSONDecodeError:
+                    # Most likely, the value just continues in the next chunk.
+                    chunk = fp.read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        raise
+                    buffer = buffer[position:] + chunk
+                    position = 0
+            yield value
+            state = "next"
+
+
+class JsonExpectations:
+    """
+    Iterable over the expectations in a JSON file, which also tells how much of it has been read.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.size = os.path.getsize(filename)
+        self.reader = None
+
+    def __iter__(self):
+        self.reader = ReopeningReader(self.filename)
+        return iter_json_array(self.reader)
+
+    def bytes_read(self):
+        return 0 if self.reader is None else self.reader.offset
+
+    def fraction_read(self):
+        return self.bytes_read() / self.size if self.size else None
+
+
+class JsonArrayWriter:
+    """
+    Writes a JSON array one element at a time. The output is identical to json.dump of a list.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.count = 0
+        fp.write("[")
+
+    def write(self, value):
+        # E.g. an expectation_record.Expectation, which behaves like a dict, but isn't one.
+        # json.dumps, unlike json.dump, uses the C encoder, which is several times faster.
+        self.write_encoded(json.dumps(value if isinstance(value, dict) else dict(value)))
+
+    def write_encoded(self, text, count=1):
+        """
+        Writes 'count' elements that are already encoded as JSON, and separated by ', '.
+        """
+        if self.count:
+            self.fp.write(", ")
+        self.fp.write(text)
+        self.count += count
+
+    def close(self):
+        self.fp.write("]")
+
+
+class JsonFileWriter:
+    def __init__(self, filename):
+        self.fp = open(filename, "w")
+        self.writer = JsonArrayWriter(self.fp)
+
+    def write(self, expectation):
+        self.writer.write(expectation)
+
+    def write_encoded(self, text, count=1):
+        self.writer.write_encoded(text, count)
+
+    def close(self):
+        self.writer.close()
+        self.fp.close()
+
+
+def open_expectations(filename):
+    """
+    Returns an iterable over all expectations in the given file, without loading them all at once.
+    """
+    # Imported here, because expectation_store itself needs this module.
+    import expectation_store
+
+    if expectation_store.is_store(filename):
+        return expectation_store.ExpectationStore(filename)
+    return JsonExpectations(filename)
+
+
+def create_expectation_writer(filename):
+    """
+    Returns an object with the methods write(expectation) and close(). The format depends on the filename.
+    """
+    import expectation_store
+
+    if filename.endswith(STORE_SUFFIX):
+        return expectation_store.ExpectationStoreWriter(filename)
+    return JsonFileWriter(filename)
@@ -0,0 +1,188 @@
+"""
+Compact in-memory representation of a single expectation, for wherever many of them are kept in
+memory at once, e.g. in check_expect.py --watch or merge_expectations.py update. Converting costs
+some CPU time, so it's not worth it for expectations that are just streamed through.
+
+A plain expectation dict, with its 14 keys, its own name string, its own list of packages and its
+own empty 'pax_headers', takes up about a kilobyte. An Expectation uses __slots__ instead, keeps
+the name as a tuple of interned components (shared with all other paths that have the same
+components, and with the 'children' of directories), the filetype as a small int, the sha256 as
+raw bytes, and doesn't store empty 'pax_headers' at all.
+
+It behaves like the dict it was made from (it's a MutableMapping), so all code that works on
+expectation dicts works on it, too. dict(expectation) turns it back into a plain dict.
+"""
+
+import collections.abc
+import expectation_io
+import sys
+
+
+FILETYPES = ["reg", "dir", "sym", "lnk", "chr", "blk", "fifo"]
+FILETYPE_CODES = {filetype: code for code, filetype in enumerate(FILETYPES)}
+DIGEST_SIZE = 32  # sha256
+# In the same order as in the dicts written by deb2fsexpect.py.
+KEYS = [
+    "type",
+    "filetype",
+    "name",
+    "size",
+    "mtime",
+    "mode",
+    "linkname",
+    "uid",
+    "gid",
+    "pax_headers",
+    "sha256",
+    "dev_inode",
+    "children",
+    "packages",
+    "chunks",
+]
+# Only present in some expectations; None means absent.
+OPTIONAL_KEYS = {"packages", "chunks"}
+# Stored as is, in a slot of the same name.
+PLAIN_KEYS = {"size", "mtime", "mode", "linkname", "uid", "gid", "dev_inode", "chunks"}
+# Values that repeat a lot, like mtimes, modes, owners and lists of packages, are shared as well.
+SHARED_VALUES = dict()
+
+
+def shared(value):
+    # Keyed by the type, too, since e.g. an mtime of 1.0 must not turn into 1.
+    return SHARED_VALUES.setdefault((type(value), value), value)
+
+
+def intern_all(strings):
+    return None if strings is None else tuple(sys.intern(string) for string in strings)
+
+
+def parse_digest(value):
+    """
+    Returns the hex digest as bytes, or None if it isn't one.
+    """
+    try:
+        digest = bytes.fromhex(value)
+    except (TypeError, ValueError):
+        return None
+    return digest if len(digest) == DIGEST_SIZE else None
+
+
+def canonical_name(parts):
+    return "./" + "/".join(parts) if parts else "."
+
+
+class Expectation(collections.abc.MutableMapping):
+    __slots__ = [
+        "parts",
+        "filetype_code",
+        "size",
+        "mtime",
+        "mode",
+        "linkname",
+        "uid",
+        "gid",
+        "pax_headers",
+        "digest",
+        "dev_inode",
+        "children",
+        "packages",
+        "chunks",
+        # Any keys that don't fit the above, e.g. a name that isn't canonical. Usually None.
+        "extra",
+    ]
+
+    def __init__(self, expectation):
+        self.parts = self.filetype_code = self.size = self.mtime = self.mode = self.linkname = None
+        self.uid = self.gid = self.pax_headers = self.digest = self.dev_inode = self.children = None
+        self.packages = self.chunks = self.extra = None
+        for key, value in expectation.items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        if key in PLAIN_KEYS:
+            value = getattr(self, key)
+        elif key == "type":
+            return "file"
+        elif key == "filetype":
+            return FILETYPES[self.filetype_code]
+        elif key == "name":
+            return canonical_name(self.parts)
+        elif key == "pax_headers":
+            # A new dict each time, so that modifying it can't affect other expectations.
+            return dict() if self.pax_headers is None else self.pax_headers
+        elif key == "sha256":
+            return None if self.digest is None else self.digest.hex()
+        elif key == "children":
+            return None if self.children is None else list(self.children)
+        elif key == "packages":
+            value = None if self.packages is None else list(self.packages)
+        else:
+            raise KeyError(key)
+        if value is None and key in OPTIONAL_KEYS:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if self.extra is not None:
+            self.extra.pop(key, None)
+        if key in PLAIN_KEYS:
+            if key in ("mtime", "mode", "uid", "gid"):
+                value = shared(value)
+            setattr(self, key, value)
+        elif key == "type" and value == "file":
+            pass
+        elif key == "filetype" and value in FILETYPE_CODES:
+            self.filetype_code = FILETYPE_CODES[value]
+        elif key == "name":
+            self.parts = intern_all(expectation_io.name_to_parts(value))
+            if value != canonical_name(self.parts):
+                self.set_extra(key, value)
+        elif key == "pax_headers":
+            self.pax_headers = value if value else None
+        elif key == "sha256" and value is None:
+            self.digest = None
+        elif key == "sha256" and (digest := parse_digest(value)) is not None:
+            self.digest = digest
+        elif key == "children":
+            self.children = intern_all(value)
+        elif key == "packages":
+            self.packages = None if value is None else shared(intern_all(value))
+        else:
+            self.set_extra(key, value)
+
+    def set_extra(self, key, value):
+        if self.extra is None:
+            self.extra = dict()
+        self.extra[key] = value
+
+    def __delitem__(self, key):
+        if self.extra is not None and key in self.extra:
+            del self.extra[key]
+        elif key in OPTIONAL_KEYS and getattr(self, key) is not None:
+            setattr(self, key, None)
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        for key in KEYS:
+            if key not in OPTIONAL_KEYS or getattr(self, key) is not None:
+                yield key
+        if self.extra is not None:
+            yield from (key for key in self.extra if key not in KEYS)
+
+    def __len__(self):
+        return sum(1 for _key in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def compact(expectation):
+    """
+    Returns the expectation as an Expectation, which may be the same object.
+    """
+    if isinstance(expectation, Expectation):
+        return expectation
+    return Expectation(expectation)
@@ -0,0 +1,480 @@
+"""
+Compact, indexed on-disk format for expectations, based on SQLite.
+
+Path components are interned, and each path is stored as a (parent, component) pair, so
+that long common prefixes like 'usr/share/doc/' are stored only once. There is an index from
+paths to expectations, so single paths can be looked up without reading everything.
+Iteration happens in small batches, and only keeps the database open during each batch.
+Names are normalized on the way, e.g. the root directory './' always comes back as '.', and
+expectations always come back in the order of expectation_io.expectation_sort_key.
+Expectations may carry a list of 'packages' they came from; there is an index from packages
+to expectations, so that a merged store can be updated in place (see merge_expectations.py),
+along with the 'variants' of each package, in case it contributed something different.
+The optional per-chunk digests of large files are stored as one blob of concatenated digests.
+"""
+
+import contextlib
+import expectation_io
+import heapq
+import json
+import os
+import pathlib
+import sqlite3
+
+
+STORE_MAGIC = b"SQLite format 3\x00"
+STORE_FORMAT_VERSION = 4
+STORE_BATCH_SIZE = 4096
+STORE_NAME_CACHE_SIZE = 65536
+DIGEST_SIZE = 32  # sha256
+
+STORE_SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE components (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE paths (
+    id INTEGER PRIMARY KEY,
+    parent INTEGER REFERENCES paths(id),
+    component INTEGER REFERENCES components(id),
+    UNIQUE (parent, component)
+);
+CREATE TABLE expectations (
+    seq INTEGER PRIMARY KEY,
+    path INTEGER NOT NULL REFERENCES paths(id),
+    sort_key BLOB NOT NULL,
+    filetype TEXT NOT NULL,
+    size INTEGER,
+    mtime,  -- No type affinity, so that integers stay integers and floats stay floats
+    mode INTEGER NOT NULL,
+    linkname TEXT,
+    uid INTEGER NOT NULL,
+    gid INTEGER NOT NULL,
+    pax_headers TEXT,
+    sha256 BLOB,
+    chunk_size INTEGER,
+    chunk_sha256 BLOB,
+    dev_major INTEGER,
+    dev_minor INTEGER,
+    has_children INTEGER NOT NULL,
+    has_packages INTEGER NOT NULL
+);
+CREATE TABLE children (
+    seq INTEGER NOT NULL REFERENCES expectations(seq),
+    position INTEGER NOT NULL,
+    component INTEGER NOT NULL REFERENCES components(id),
+    PRIMARY KEY (seq, position)
+) WITHOUT ROWID;
+CREATE TABLE packages (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE expectation_packages (
+    seq INTEGER NOT NULL REFERENCES expectations(seq),
+    package INTEGER NOT NULL REFERENCES packages(id),
+    variant TEXT,  -- JSON of what this package contributed differently, if anything
+    PRIMARY KEY (seq, package)
+) WITHOUT ROWID;
+"""
+
+# Created after all data has been inserted, which is much faster than maintaining it all along.
+STORE_INDEXES = """
+CREATE INDEX expectations_path ON expectations(path);
+CREATE INDEX expectations_order ON expectations(sort_key, seq);
+CREATE INDEX expectation_packages_package ON expectation_packages(package, seq);
+"""
+
+EXPECTATION_COLUMNS = "seq, path, sort_key, filetype, size, mtime, mode, linkname, uid, gid, pax_headers, sha256, chunk_size, chunk_sha256, dev_major, dev_minor, has_children, has_packages"
+
+
+def is_store(filename):
+    try:
+        with open(filename, "rb") as fp:
+            return fp.read(len(STORE_MAGIC)) == STORE_MAGIC
+    except IsADirectoryError:
+        return False
+
+
+def connect_read_only(filename):
+    uri = pathlib.Path(filename).absolute().as_uri() + "?mode=ro"
+    return sqlite3.connect(uri, uri=True)
+
+
+def sort_key_blob(parts):
+    """
+    Same order as expectation_io.parts_sort_key, but as bytes that SQLite can compare.
+    """
+    # NUL can't appear in file names, and sorts before everything else, so a shorter
+    # component sorts before a longer one that starts the same way.
+    return b"".join(b"0" + part.encode("utf-8", "surrogateescape") + b"\x00" for part in parts) + b"1"
+
+
+class StoreAccess:
+    """
+    Functionality shared between reading and writing stores.
+    """
+
+    def __init__(self):
+        self.path_names = dict()
+
+    def path_name(self, db, path_id):
+        name = self.path_names.get(path_id)
+        if name is not None:
+            return name
+        parent_id, component = db.execute(
+            "SELECT paths.parent, components.name FROM paths LEFT JOIN components ON components.id = paths.component WHERE paths.id = ?",
+            (path_id,),
+        ).fetchone()
+        if parent_id is None:
+            name = "."
+        else:
+            name = self.path_name(db, parent_id) + "/" + component
+        if len(self.path_names) >= STORE_NAME_CACHE_SIZE:
+            self.path_names.clear()
+        self.path_names[path_id] = name
+        return name
+
+    def row_to_expectation(self, db, row):
+        (
+            seq, path_id, _sort_key, filetype, size, mtime, mode, linkname, uid, gid,
+            pax_headers, sha256, chunk_size, chunk_sha256, dev_major, dev_minor, has_children, has_packages,
+        ) = row
+        if has_children:
+            children = [
+                child
+                for (child,) in db.execute(
+                    "SELECT components.name FROM children JOIN components ON components.id = children.component WHERE children.seq = ? ORDER BY children.position",
+                    (seq,),
+                )
+            ]
+        else:
+            children = None
+        expectation = {
+            "type": "file",
+            "filetype": filetype,
+            "name": self.path_name(db, path_id),
+            "size": size,
+            "mtime": mtime,
+            "mode": mode,
+            "linkname": linkname,
+            "uid": uid,
+            "gid": gid,
+            "pax_headers": json.loads(pax_headers) if pax_headers is not None else dict(),
+            "sha256": None if sha256 is None else sha256.hex(),
+            "dev_inode": None if dev_major is None else [dev_major, dev_minor],
+            "children": children,
+        }
+        variants = dict()
+        if has_packages:
+            expectation["packages"] = []
+            for package, variant in db.execute(
+                "SELECT packages.name, expectation_packages.variant FROM expectation_packages JOIN packages ON packages.id = expectation_packages.package WHERE expectation_packages.seq = ? ORDER BY packages.name",
+                (seq,),
+            ):
+                expectation["packages"].append(package)
+                if variant is not None:
+                    variants[package] = json.loads(variant)
+        if chunk_size is not None:
+            expectation["chunks"] = {
+                "size": chunk_size,
+                "sha256": [chunk_sha256[i : i + DIGEST_SIZE].hex() for i in range(0, len(chunk_sha256), DIGEST_SIZE)],
+            }
+        if variants:
+            expectation["variants"] = variants
+        return expectation
+
+    def find_path_id(self, db, parts):
+        path_id = db.execute("SELECT id FROM paths WHERE parent IS NULL").fetchone()[0]
+        for part in parts:
+            row = db.execute(
+                "SELECT paths.id FROM paths JOIN components ON components.id = paths.component WHERE paths.parent = ? AND components.name = ?",
+                (path_id, part),
+            ).fetchone()
+            if row is None:
+                return None
+            path_id = row[0]
+        return path_id
+
+    def find_rows(self, db, parts):
+        path_id = self.find_path_id(db, parts)
+        if path_id is None:
+            return []
+        return db.execute(
+            f"SELECT {EXPECTATION_COLUMNS} FROM expectations WHERE path = ? ORDER BY seq", (path_id,)
+        ).fetchall()
+
+
+class ExpectationStoreWriter(StoreAccess):
+    """
+    Writes expectations into a new store. With edit=True, modifies an existing store in place
+    instead, and offers a few more methods for that.
+    """
+
+    def __init__(self, filename, edit=False):
+        super().__init__()
+        self.filename = filename
+        self.edit = edit
+        if edit:
+            self.db = sqlite3.connect(filename)
+            check_version(self.db, filename)
+            self.root_id = self.db.execute("SELECT id FROM paths WHERE parent IS NULL").fetchone()[0]
+        else:
+            self.temp_filename = filename + ".tmp"
+            if os.path.exists(self.temp_filename):
+                os.remove(self.temp_filename)
+            self.db = sqlite3.connect(self.temp_filename)
+            self.db.execute("PRAGMA journal_mode = OFF")
+            self.db.execute("PRAGMA synchronous = OFF")
+            self.db.executescript(STORE_SCHEMA)
+            self.db.execute("INSERT INTO meta VALUES ('version', ?)", (str(STORE_FORMAT_VERSION),))
+            self.root_id = self.db.execute("INSERT INTO paths (parent, component) VALUES (NULL, NULL)").lastrowid
+        self.component_ids = dict()
+        # Maps the parts of recently used directories to their path id. Since the expectations
+        # usually arrive sorted, this is just a handful of entries.
+        self.path_ids = dict()
+        self.package_ids = dict()
+        self.count = 0
+
+    def intern(self, table, cache, name):
+        interned_id = cache.get(name)
+        if interned_id is not None:
+            return interned_id
+        row = self.db.execute(f"SELECT id FROM {table} WHERE name = ?", (name,)).fetchone()
+        if row is not None:
+            interned_id = row[0]
+        else:
+            interned_id = self.db.execute(f"INSERT INTO {table} (name) VALUES (?)", (name,)).lastrowid
+        if len(cache) >= STORE_NAME_CACHE_SIZE:
+            cache.clear()
+        cache[name] = interned_id
+        return interned_id
+
+    def component_id(self, component):
+        return self.intern("components", self.component_ids, component)
+
+    def package_id(self, package):
+        return self.intern("packages", self.package_ids, package)
+
+    def path_id(self, parts):
+        if not parts:
+            return self.root_id
+        path_id = self.path_ids.get(parts)
+        if path_id is not None:
+            return path_id
+        parent_id = self.path_id(parts[:-1])
+        component_id = self.component_id(parts[-1])
+        row = self.db.execute(
+            "SELECT id FROM paths WHERE parent = ? AND component = ?", (parent_id, component_id)
+        ).fetchone()
+        if row is not None:
+            path_id = row[0]
+        else:
+            path_id = self.db.execute(
+                "INSERT INTO paths (parent, component) VALUES (?, ?)", (parent_id, component_id)
+            ).lastrowid
+        if len(self.path_ids) >= STORE_NAME_CACHE_SIZE:
+            self.path_ids.clear()
+        self.path_ids[parts] = path_id
+        return path_id
+
+    def write(self, expectation):
+        """
+        Adds the expectation, and returns its seq.
+        """
+        assert expectation["type"] == "file", expectation
+        parts = expectation_io.name_to_parts(expectation["name"])
+        dev_inode = expectation["dev_inode"]
+        sha256 = expectation["sha256"]
+        packages = expectation.get("packages")
+        chunks = expectation.get("chunks")
+        seq = self.db.execute(
+            f"INSERT INTO expectations ({EXPECTATION_COLUMNS}) VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                self.path_id(parts),
+                sort_key_blob(parts),
+                expectation["filetype"],
+                expectation["size"],
+                expectation["mtime"],
+                expectation["mode"],
+                expectation["linkname"],
+                expectation["uid"],
+                expectation["gid"],
+                # Almost always empty, so don't even store that:
+                json.dumps(expectation["pax_headers"]) if expectation["pax_headers"] else None,
+                None if sha256 is None else bytes.fromhex(sha256),
+                None if chunks is None else chunks["size"],
+                None if chunks is None else b"".join(bytes.fromhex(digest) for digest in chunks["sha256"]),
+                None if dev_inode is None else dev_inode[0],
+                None if dev_inode is None else dev_inode[1],
+                expectation["children"] is not None,
+                packages is not None,
+            ),
+        ).lastrowid
+        if expectation["children"] is not None:
+            self.set_children(seq, expectation["children"])
+        if packages is not None:
+            self.set_packages(seq, packages, expectation.get("variants"))
+        self.count += 1
+        return seq
+
+    def set_packages(self, seq, packages, variants=None):
+        variants = variants or dict()
+        self.db.execute("DELETE FROM expectation_packages WHERE seq = ?", (seq,))
+        self.db.execute("UPDATE expectations SET has_packages = ? WHERE seq = ?", (packages is not None, seq))
+        if packages is not None:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO expectation_packages (seq, package, variant) VALUES (?, ?, ?)",
+                [
+                    (seq, self.package_id(package), json.dumps(variants[package]) if package in variants else None)
+                    for package in packages
+                ],
+            )
+
+    def set_children(self, seq, children):
+        self.db.execute("DELETE FROM children WHERE seq = ?", (seq,))
+        self.db.execute("UPDATE expectations SET has_children = ? WHERE seq = ?", (children is not None, seq))
+        if children is not None:
+            self.db.executemany(
+                "INSERT INTO children (seq, position, component) VALUES (?, ?, ?)",
+                [(seq, i, self.component_id(child)) for i, child in enumerate(children)],
+            )
+
+    def find(self, parts):
+        """
+        Returns a list of (seq, expectation) for the given path.
+        """
+        return [(row[0], self.row_to_expectation(self.db, row)) for row in self.find_rows(self.db, parts)]
+
+    def replace(self, seq, expectation):
+        """
+        Replaces the expectation with the given seq, and returns the new seq.
+        """
+        self.delete(seq)
+        return self.write(expectation)
+
+    def delete(self, seq):
+        self.db.execute("DELETE FROM children WHERE seq = ?", (seq,))
+        self.db.execute("DELETE FROM expectation_packages WHERE seq = ?", (seq,))
+        self.db.execute("DELETE FROM expectations WHERE seq = ?", (seq,))
+        self.count -= 1
+
+    def package_seqs(self, package):
+        return [
+            seq
+            for (seq,) in self.db.execute(
+                "SELECT expectation_packages.seq FROM expectation_packages JOIN packages ON packages.id = expectation_packages.package WHERE packages.name = ? ORDER BY expectation_packages.seq",
+                (package,),
+            )
+        ]
+
+    def expectation(self, seq):
+        row = self.db.execute(f"SELECT {EXPECTATION_COLUMNS} FROM expectations WHERE seq = ?", (seq,)).fetchone()
+        return self.row_to_expectation(self.db, row)
+
+    def child_names(self, parts):
+        """
+        Returns the sorted names of all direct children of the given path that have at least one expectation.
+        """
+        path_id = self.find_path_id(self.db, parts)
+        if path_id is None:
+            return []
+        return [
+            name
+            for (name,) in self.db.execute(
+                "SELECT DISTINCT components.name FROM paths JOIN components ON components.id = paths.component JOIN expectations ON expectations.path = paths.id WHERE paths.parent = ? ORDER BY components.name",
+                (path_id,),
+            )
+        ]
+
+    def close(self):
+        if not self.edit:
+            self.db.executescript(STORE_INDEXES)
+        self.db.commit()
+        self.db.close()
+        if not self.edit:
+            os.replace(self.temp_filename, self.filename)
+
+
+def check_version(db, filename):
+    row = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+    if row is None or row[0] != str(STORE_FORMAT_VERSION):
+        raise ValueError(f"Unsupported expectation store version in {filename}, please convert it again")
+
+
+class ExpectationStore(StoreAccess):
+    """
+    Read-only access to a store written by ExpectationStoreWriter. Iterating yields the same
+    dicts that json.load would have produced, sorted by expectation_io.expectation_sort_key.
+    """
+
+    def __init__(self, filename):
+        super().__init__()
+        self.filename = filename
+        self.db = None
+        with contextlib.closing(connect_read_only(filename)) as db:
+            check_version(db, filename)
+
+    def iter_keyed(self, where="1", parameters=()):
+        """
+        Yields ((sort_key, seq), expectation) for all matching rows, in order.
+        """
+        last = (b"", 0)
+        while True:
+            # Reconnect for each batch, so that many stores can be iterated at the same time
+            # without running out of file descriptors.
+            with contextlib.closing(connect_read_only(self.filename)) as db:
+                rows = db.execute(
+                    f"SELECT {EXPECTATION_COLUMNS} FROM expectations WHERE (sort_key, seq) > (?, ?) AND ({where}) ORDER BY sort_key, seq LIMIT ?",
+                    (*last, *parameters, STORE_BATCH_SIZE),
+                ).fetchall()
+                batch = [((row[2], row[0]), self.row_to_expectation(db, row)) for row in rows]
+            if not rows:
+                return
+            last = batch[-1][0]
+            yield from batch
+
+    def __iter__(self):
+        return (expectation for _key, expectation in self.iter_keyed())
+
+    def iter_package_keyed(self, packages):
+        conditions = " OR ".join("packages.name = ? OR substr(packages.name, 1, ?) = ?" for _ in packages)
+        parameters = []
+        for package in packages:
+            # 'bash' also matches 'bash:amd64', 'bash:i386', etc.
+            parameters.extend([package, len(package) + 1, package + ":"])
+        with contextlib.closing(connect_read_only(self.filename)) as db:
+            rows = db.execute(
+                f"SELECT {EXPECTATION_COLUMNS} FROM expectations WHERE seq IN (SELECT expectation_packages.seq FROM expectation_packages JOIN packages ON packages.id = expectation_packages.package WHERE {conditions}) ORDER BY sort_key, seq",
+                parameters,
+            ).fetchall()
+            return [((row[2], row[0]), self.row_to_expectation(db, row)) for row in rows]
+
+    def select(self, packages=(), prefixes=()):
+        """
+        Yields all expectations that belong to any of the packages (given as 'name' or 'name:arch'),
+        or that are at or below any of the prefixes (given as parts), in the usual order.
+        Only the selected expectations are read, thanks to the indexes.
+        """
+        streams = []
+        for prefix in prefixes:
+            # The whole subtree shares the same sort key prefix, which is followed by either "0" or "1".
+            start = sort_key_blob(prefix)[:-1]
+            streams.append(self.iter_keyed("sort_key >= ? AND sort_key < ?", (start, start + b"\xff")))
+        if packages:
+            streams.append(self.iter_package_keyed(packages))
+        last_key = None
+        for key, expectation in heapq.merge(*streams, key=lambda item: item[0]):
+            # Skip expectations that were selected more than once.
+            if key != last_key:
+                yield expectation
+            last_key = key
+
+    def __len__(self):
+        with contextlib.closing(connect_read_only(self.filename)) as db:
+            return db.execute("SELECT COUNT(*) FROM expectations").fetchone()[0]
+
+    def lookup(self, name):
+        """
+        Returns the (first) expectation for the given name, or None if there is none.
+        """
+        if self.db is None:
+            self.db = connect_read_only(self.filename)
+        rows = self.find_rows(self.db, expectation_io.name_to_parts(name))
+        if not rows:
+            return None
+        return self.row_to_expectation(self.db, rows[0])
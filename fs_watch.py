@@ -0,0 +1,303 @@
+"""
+Minimal ctypes bindings for fanotify(7) and inotify(7), as needed by check_expect.py --watch.
+
+Both watchers report changes as a list of (parts, subtree) pairs, relative to the watched root:
+'parts' is the path that changed (or whose directory entry changed), and 'subtree' says whether
+everything below it needs to be checked again, too, e.g. because a directory was moved in.
+If the kernel dropped events because its queue overflowed, the whole tree is reported instead.
+
+fanotify watches entire filesystems at once, but needs CAP_SYS_ADMIN and Linux 5.9. inotify
+works for everyone, but needs one watch per directory, and those are limited by
+/proc/sys/fs/inotify/max_user_watches.
+"""
+
+import ctypes
+import errno
+import expectation_io
+import os
+import re
+import struct
+import sys
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+INOTIFY_MASK = IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_ENTRY_EVENTS = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+# struct inotify_event: wd, mask, cookie, len, followed by the name.
+INOTIFY_EVENT = struct.Struct("=iIII")
+
+FAN_CLOEXEC = 0x00000001
+FAN_NONBLOCK = 0x00000002
+FAN_REPORT_DIR_FID = 0x00000400
+FAN_REPORT_NAME = 0x00000800
+FAN_MARK_ADD = 0x00000001
+FAN_MARK_FILESYSTEM = 0x00000100
+FAN_MODIFY = 0x00000002
+FAN_ATTRIB = 0x00000004
+FAN_MOVED_FROM = 0x00000040
+FAN_MOVED_TO = 0x00000080
+FAN_CREATE = 0x00000100
+FAN_DELETE = 0x00000200
+FAN_Q_OVERFLOW = 0x00004000
+FAN_ONDIR = 0x40000000
+FAN_MASK = FAN_MODIFY | FAN_ATTRIB | FAN_MOVED_FROM | FAN_MOVED_TO | FAN_CREATE | FAN_DELETE | FAN_ONDIR
+FAN_ENTRY_EVENTS = FAN_MOVED_FROM | FAN_MOVED_TO | FAN_CREATE | FAN_DELETE
+FAN_EVENT_INFO_TYPE_DFID_NAME = 2
+AT_FDCWD = -100
+# struct fanotify_event_metadata: event_len, vers, reserved, metadata_len, mask, fd, pid
+FANOTIFY_EVENT = struct.Struct("=IBBHQii")
+# struct fanotify_event_info_header (info_type, pad, len), then __kernel_fsid_t
+FANOTIFY_INFO_HEADER = struct.Struct("=BBHII")
+# struct file_handle: handle_bytes, handle_type, followed by the handle itself.
+FILE_HANDLE_HEADER = struct.Struct("=Ii")
+
+READ_BUFFER_SIZE = 64 * 1024
+
+libc = ctypes.CDLL(None, use_errno=True)
+
+
+def check_call(result):
+    if result < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return result
+
+
+def relative_parts(root, path):
+    """
+    Returns the parts of 'path' relative to 'root', or None if it is not inside of it.
+    """
+    if path == root:
+        return ()
+    if root == "/":
+        return expectation_io.name_to_parts(path)
+    if path.startswith(root + "/"):
+        return expectation_io.name_to_parts(path[len(root) :])
+    return None
+
+
+def mount_points_below(root):
+    """
+    Returns all mount points at or below 'root', according to /proc/self/mountinfo.
+    """
+    mount_points = []
+    with open("/proc/self/mountinfo", "r") as fp:
+        for line in fp:
+            # Spaces and such are escaped as octal, e.g. '\040'.
+            mount_point = re.sub(r"\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)), line.split(" ")[4])
+            if relative_parts(root, mount_point) is not None:
+                mount_points.append(mount_point)
+    return mount_points
+
+
+def statvfs_fsid(fsid_val0, fsid_val1):
+    """
+    Combines the two halves of a __kernel_fsid_t the same way as os.statvfs().f_fsid.
+    """
+    return fsid_val0 | (fsid_val1 << 32)
+
+
+class FanotifyWatcher:
+    # Watches entire filesystems, so there is no need to add each directory.
+    per_directory = False
+
+    def __init__(self, root):
+        self.root = os.path.realpath(root)
+        libc.fanotify_mark.argtypes = [ctypes.c_int, ctypes.c_uint, ctypes.c_uint64, ctypes.c_int, ctypes.c_char_p]
+        self.fd = check_call(
+            libc.fanotify_init(
+                FAN_CLOEXEC | FAN_NONBLOCK | FAN_REPORT_DIR_FID | FAN_REPORT_NAME, os.O_RDONLY | os.O_CLOEXEC
+            )
+        )
+        # Maps the fsid of each watched filesystem to a file descriptor on it, for open_by_handle_at.
+        self.mount_fds = dict()
+        skipped = []
+        # Marking the root marks the filesystem it is on, even if it's not a mount point itself.
+        mount_points = [self.root]
+        mount_points.extend(mount_point for mount_point in mount_points_below(self.root) if mount_point != self.root)
+        for mount_point in mount_points:
+            try:
+                check_call(
+                    libc.fanotify_mark(
+                        self.fd,
+                        FAN_MARK_ADD | FAN_MARK_FILESYSTEM,
+                        FAN_MASK,
+                        AT_FDCWD,
+                        os.fsencode(mount_point),
+                    )
+                )
+            except OSError:
+                if mount_point == self.root:
+                    self.close()
+                    raise
+                # Typically pseudo filesystems like /proc, which have no expectations anyway.
+                skipped.append(mount_point)
+                continue
+            fsid = os.statvfs(mount_point).f_fsid
+            if fsid not in self.mount_fds:
+                self.mount_fds[fsid] = os.open(mount_point, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+        if skipped:
+            print(f"Warning: Can't watch {len(skipped)} mount points: {', '.join(skipped)}", file=sys.stderr)
+
+    def fileno(self):
+        return self.fd
+
+    def watch_dir(self, parts):
+        pass
+
+    def resolve(self, fsid, handle):
+        """
+        Returns the current path of the directory with the given handle, or None if it's gone.
+        """
+        mount_fd = self.mount_fds.get(fsid)
+        if mount_fd is None:
+            raise OSError(errno.EXDEV, "Event on an unknown filesystem")
+        handle_buffer = ctypes.create_string_buffer(handle, len(handle))
+        try:
+            fd = check_call(libc.open_by_handle_at(mount_fd, handle_buffer, os.O_PATH | os.O_CLOEXEC))
+        except OSError as e:
+            if e.errno == errno.ESTALE:
+                # The directory is gone already, but then its parent got an event, too.
+                return None
+            raise
+        try:
+            return os.readlink(f"/proc/self/fd/{fd}")
+        finally:
+            os.close(fd)
+
+    def read_events(self):
+        changes = []
+        while True:
+            try:
+                data = os.read(self.fd, READ_BUFFER_SIZE)
+            except BlockingIOError:
+                return changes
+            offset = 0
+            while offset < len(data):
+                event_len, _vers, _reserved, metadata_len, mask, fd, _pid = FANOTIFY_EVENT.unpack_from(data, offset)
+                if fd >= 0:
+                    os.close(fd)
+                if mask & FAN_Q_OVERFLOW:
+                    changes.append(((), True))
+                else:
+                    changes.extend(self.parse_info(data[offset + metadata_len : offset + event_len], mask))
+                offset += event_len
+
+    def parse_info(self, info, mask):
+        offset = 0
+        while offset < len(info):
+            info_type, _pad, info_len, fsid_val0, fsid_val1 = FANOTIFY_INFO_HEADER.unpack_from(info, offset)
+            if info_type == FAN_EVENT_INFO_TYPE_DFID_NAME:
+                handle_start = offset + FANOTIFY_INFO_HEADER.size
+                handle_bytes = FILE_HANDLE_HEADER.unpack_from(info, handle_start)[0]
+                name_start = handle_start + FILE_HANDLE_HEADER.size + handle_bytes
+                handle = info[handle_start:name_start]
+                name = info[name_start : offset + info_len].split(b"\0", 1)[0]
+                try:
+                    directory = self.resolve(statvfs_fsid(fsid_val0, fsid_val1), handle)
+                except OSError:
+                    # Can't tell where this happened, so better check everything.
+                    yield (), True
+                else:
+                    if directory is not None:
+                        path = directory if name in (b"", b".") else os.path.join(directory, os.fsdecode(name))
+                        # The root itself is an entry of a directory outside of it.
+                        parts = relative_parts(self.root, path)
+                        if parts is not None:
+                            yield parts, bool(mask & FAN_ONDIR and mask & FAN_ENTRY_EVENTS)
+            offset += info_len
+
+    def close(self):
+        for fd in self.mount_fds.values():
+            os.close(fd)
+        os.close(self.fd)
+
+
+class InotifyWatcher:
+    # Needs a watch for each directory; the caller adds them through watch_dir.
+    per_directory = True
+
+    def __init__(self, root):
+        self.root = root
+        self.fd = check_call(libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        self.wd_to_parts = dict()
+        self.out_of_watches = False
+
+    def fileno(self):
+        return self.fd
+
+    def watch_dir(self, parts):
+        if self.out_of_watches:
+            return
+        path = os.path.join(self.root, *parts)
+        try:
+            wd = check_call(
+                libc.inotify_add_watch(
+                    self.fd, os.fsencode(path), INOTIFY_MASK | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+                )
+            )
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                print(
+                    "Warning: Out of inotify watches, some directories are not watched. See /proc/sys/fs/inotify/max_user_watches",
+                    file=sys.stderr,
+                )
+                self.out_of_watches = True
+            # Otherwise, the directory is missing or not a directory, which is reported elsewhere.
+            return
+        self.wd_to_parts[wd] = parts
+
+    def read_events(self):
+        changes = []
+        while True:
+            try:
+                data = os.read(self.fd, READ_BUFFER_SIZE)
+            except BlockingIOError:
+                return changes
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, name_len = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset : offset + name_len].split(b"\0", 1)[0]
+                offset += name_len
+                if mask & IN_Q_OVERFLOW:
+                    changes.append(((), True))
+                    continue
+                if mask & IN_IGNORED:
+                    # The directory was deleted or replaced. The latter gets a new watch when rechecked.
+                    self.wd_to_parts.pop(wd, None)
+                    continue
+                parts = self.wd_to_parts.get(wd)
+                if parts is None:
+                    continue
+                if name:
+                    parts += (os.fsdecode(name),)
+                changes.append((parts, bool(mask & IN_ISDIR and mask & INOTIFY_ENTRY_EVENTS)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+def open_watcher(root):
+    """
+    Returns a FanotifyWatcher if permitted, otherwise an InotifyWatcher.
+    """
+    try:
+        return FanotifyWatcher(root)
+    except (OSError, AttributeError) as e:
+        # AttributeError: The C library doesn't even have fanotify_init.
+        print(f"Note: Can't use fanotify ({e}), falling back to inotify", file=sys.stderr)
+    return InotifyWatcher(root)
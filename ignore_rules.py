@@ -0,0 +1,148 @@
+"""
+Compiled ignore rules for check_expect.py.
+
+Each rule has a pattern like '/var/log', '/home/*/.cache', or '**/__pycache__', which is matched
+against whole paths, one component at a time: '*', '?' and '[...]' work like in fnmatch, but never
+match across a '/', and '**' matches any number of components (including none).
+All patterns are compiled into a single trie, so matching a path costs one step per component,
+regardless of the number of rules. Since expectations arrive grouped by directory, the state
+for each directory is cached, and matching a file costs just a single step.
+"""
+
+import expectation_io
+import fnmatch
+import re
+import threading
+
+
+# What a rule does to the paths it matches:
+# - "prune": Don't check the path nor anything below it, and don't report it as extraneous either.
+# - "children": Don't report extraneous children of this directory.
+# - "extraneous": Don't report this path if it is an extraneous child of its directory.
+# - "attr": Don't check the given attribute (report key) of this path.
+RULE_KINDS = ["prune", "children", "extraneous", "attr"]
+GLOB_CHARS = re.compile(r"[*?[]")
+STATE_CACHE_SIZE = 4096
+
+
+class Rule:
+    def __init__(self, rule_id, kind, pattern, description, attribute=None):
+        assert kind in RULE_KINDS, kind
+        self.rule_id = rule_id
+        self.kind = kind
+        self.pattern = pattern
+        self.description = description
+        self.attribute = attribute
+
+
+class TrieNode:
+    def __init__(self):
+        self.literals = dict()
+        self.globs = []  # List of (compiled regex, TrieNode)
+        # A node for '**', which can be entered without consuming anything, and then consumes any component.
+        self.doublestar = None
+        # Whether this node *is* such a '**' node.
+        self.is_doublestar = False
+        self.rule_ids = []
+
+    def closure(self):
+        yield self
+        if self.doublestar is not None:
+            yield from self.doublestar.closure()
+
+
+class IgnoreRules:
+    def __init__(self, destdir="/"):
+        self.destdir_parts = expectation_io.name_to_parts(destdir)
+        self.rules = []
+        self.root = TrieNode()
+        self.used_rule_ids = set()
+        self.state_cache = dict()
+        self.lock = threading.Lock()
+
+    def add(self, kind, pattern, description, attribute=None):
+        parts = expectation_io.name_to_parts(pattern)
+        # Accept paths that include --destdir, too:
+        if self.destdir_parts and parts[: len(self.destdir_parts)] == self.destdir_parts:
+            parts = parts[len(self.destdir_parts) :]
+        rule = Rule(len(self.rules), kind, parts, description, attribute)
+        self.rules.append(rule)
+        node = self.root
+        for part in parts:
+            if part == "**":
+                if node.doublestar is None:
+                    node.doublestar = TrieNode()
+                    node.doublestar.is_doublestar = True
+                node = node.doublestar
+            elif GLOB_CHARS.search(part):
+                regex = re.compile(fnmatch.translate(part))
+                for existing_regex, existing_node in node.globs:
+                    if existing_regex.pattern == regex.pattern:
+                        node = existing_node
+                        break
+                else:
+                    new_node = TrieNode()
+                    node.globs.append((regex, new_node))
+                    node = new_node
+            else:
+                node = node.literals.setdefault(part, TrieNode())
+        node.rule_ids.append(rule.rule_id)
+        self.state_cache.clear()
+
+    def step(self, state, part):
+        next_nodes = set()
+        for node in state:
+            if node.is_doublestar:
+                next_nodes.add(node)
+            child = node.literals.get(part)
+            if child is not None:
+                next_nodes.add(child)
+            for regex, child in node.globs:
+                if regex.match(part):
+                    next_nodes.add(child)
+        return frozenset(n for next_node in next_nodes for n in next_node.closure())
+
+    def state(self, parts):
+        state = self.state_cache.get(parts)
+        if state is not None:
+            return state
+        if not parts:
+            state = frozenset(self.root.closure())
+        else:
+            state = self.step(self.state(parts[:-1]), parts[-1])
+        with self.lock:
+            if len(self.state_cache) >= STATE_CACHE_SIZE:
+                self.state_cache.clear()
+            self.state_cache[parts] = state
+        return state
+
+    def matching_rules(self, parts, kind):
+        """
+        Returns all rules of the given kind that match exactly this path, and marks them as used.
+        """
+        rules = [
+            self.rules[rule_id]
+            for node in self.state(parts)
+            for rule_id in node.rule_ids
+            if self.rules[rule_id].kind == kind
+        ]
+        if rules:
+            with self.lock:
+                self.used_rule_ids.update(rule.rule_id for rule in rules)
+        return rules
+
+    def is_pruned(self, parts):
+        # Pruning a directory prunes everything below it, too.
+        return any(self.matching_rules(parts[:i], "prune") for i in range(len(parts) + 1))
+
+    def ignores_children_of(self, parts):
+        return bool(self.matching_rules(parts, "children"))
+
+    def ignores_extraneous(self, parts):
+        return bool(self.matching_rules(parts, "extraneous")) or self.is_pruned(parts)
+
+    def ignored_attributes(self, parts):
+        return {rule.attribute for rule in self.matching_rules(parts, "attr")}
+
+    def unused_rules(self):
+        return [rule for rule in self.rules if rule.rule_id not in self.used_rule_ids]
@@ -0,0 +1,229 @@
+"""
+Instrumentation shared by deb2fsexpect.py, merge_expectations.py, and check_expect.py: Wall-clock
+time per phase, counters like the number of bytes hashed, the slowest paths, and live progress
+on stderr.
+
+With several threads, the time of each phase is summed over all of them, so the phases can add
+up to more than the total wall-clock time.
+"""
+
+import heapq
+import json
+import sys
+import threading
+import time
+
+
+DEFAULT_TOP_N = 10
+# How often the progress line is updated, in seconds.
+PROGRESS_INTERVAL = 0.5
+
+
+class Phase:
+    """
+    Context manager that adds the time spent inside of it to a phase.
+    """
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.add_time(self.name, time.perf_counter() - self.started)
+
+
+class Stats:
+    def __init__(self, tool, top_n=DEFAULT_TOP_N):
+        self.tool = tool
+        self.top_n = top_n
+        self.started = time.monotonic()
+        self.phase_seconds = dict()
+        self.phase_calls = dict()
+        self.counters = dict()
+        # Min-heap of (seconds, name), so the fastest of the slowest is the first to go.
+        self.slowest = []
+        self.lock = threading.Lock()
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def add_time(self, name, seconds, calls=1):
+        with self.lock:
+            self.phase_seconds[name] = self.phase_seconds.get(name, 0.0) + seconds
+            self.phase_calls[name] = self.phase_calls.get(name, 0) + calls
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record_path(self, name, seconds):
+        with self.lock:
+            if len(self.slowest) < self.top_n:
+                heapq.heappush(self.slowest, (seconds, name))
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (seconds, name))
+
+    def timed(self, iterable, phase, name=None):
+        """
+        Yields all items of 'iterable', and adds the time spent waiting for them to 'phase'.
+        If 'name' is given, the total is also recorded as a path, e.g. the name of a source file.
+        """
+        iterator = iter(iterable)
+        seconds = 0.0
+        calls = 0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - started
+                    calls += 1
+                yield item
+        finally:
+            self.add_time(phase, seconds, calls)
+            if name is not None:
+                self.record_path(name, seconds)
+
+    def merge(self, data):
+        """
+        Adds the phases, counters and slowest paths of another to_dict(), e.g. from a worker process.
+        """
+        for name, phase in data["phases"].items():
+            self.add_time(name, phase["seconds"], phase["calls"])
+        for name, value in data["counters"].items():
+            self.count(name, value)
+        for entry in data["slowest"]:
+            self.record_path(entry["name"], entry["seconds"])
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "tool": self.tool,
+                "wall_seconds": time.monotonic() - self.started,
+                "phases": {
+                    name: {"seconds": seconds, "calls": self.phase_calls[name]}
+                    for name, seconds in self.phase_seconds.items()
+                },
+                "counters": dict(self.counters),
+                "slowest": [{"name": name, "seconds": seconds} for seconds, name in sorted(self.slowest, reverse=True)],
+            }
+
+    def print_summary(self, file=sys.stderr):
+        data = self.to_dict()
+        wall_seconds = max(data["wall_seconds"], 1e-6)
+        print(f"{self.tool}: {data['wall_seconds']:.2f}s wall-clock time", file=file)
+        phases = sorted(data["phases"].items(), key=lambda item: item[1]["seconds"], reverse=True)
+        for name, phase in phases:
+            print(f"  {name}: {phase['seconds']:.2f}s in {phase['calls']} calls", file=file)
+        for name, value in sorted(data["counters"].items()):
+            if name.startswith("bytes"):
+                print(f"  {name}: {value / 2**20:.1f} MiB ({value / 2**20 / wall_seconds:.1f} MiB/s)", file=file)
+            else:
+                print(f"  {name}: {value} ({value / wall_seconds:.1f}/s)", file=file)
+        if data["slowest"]:
+            print("  Slowest:", file=file)
+            for entry in data["slowest"]:
+                print(f"    {entry['seconds']:.3f}s {entry['name']}", file=file)
+
+    def write_json(self, filename):
+        with open(filename, "w") as fp:
+            json.dump(self.to_dict(), fp, indent=1)
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02}:{seconds % 60:02}"
+
+
+class Progress:
+    """
+    Shows a single, continuously updated line on stderr, but only if that is a terminal.
+    'fraction' is a callable that returns how much of the work is done (between 0 and 1), or
+    None if that isn't known; otherwise there is no ETA.
+    """
+
+    def __init__(self, stats, unit, fraction=None, enabled=True):
+        self.stats = stats
+        self.unit = unit
+        self.fraction = fraction
+        self.enabled = enabled and sys.stderr.isatty()
+        self.started = time.monotonic()
+        self.done = 0
+        self.last_shown = self.started
+        self.shown = False
+        self.lock = threading.Lock()
+
+    def update(self, amount=1):
+        with self.lock:
+            self.done += amount
+            if not self.enabled:
+                return
+            now = time.monotonic()
+            if now - self.last_shown < PROGRESS_INTERVAL:
+                return
+            self.last_shown = now
+            self.show(now)
+
+    def show(self, now):
+        elapsed = max(now - self.started, 1e-6)
+        line = f"{self.stats.tool}: {self.done} {self.unit} ({self.done / elapsed:.0f}/s)"
+        bytes_hashed = self.stats.counters.get("bytes_hashed")
+        if bytes_hashed:
+            line += f", {bytes_hashed / 2**20:.0f} MiB hashed"
+        fraction = self.fraction() if self.fraction is not None else None
+        if fraction:
+            line += f", {min(fraction, 1):.1%}, ETA {format_duration(elapsed * max(1 - fraction, 0) / fraction)}"
+        # Overwrite the previous line, and clear whatever is left of it.
+        sys.stderr.write(f"\r{line}\x1b[K")
+        sys.stderr.flush()
+        self.shown = True
+
+    def finish(self):
+        if self.shown:
+            sys.stderr.write("\r\x1b[K")
+            sys.stderr.flush()
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--stats",
+        dest="print_stats",
+        action="store_true",
+        help="At the end, print the time spent in each phase, throughput, and the slowest paths to stderr. (default: don't)",
+    )
+    parser.add_argument(
+        "--stats-json",
+        metavar="FILENAME",
+        help="At the end, write the same statistics as JSON to this file, e.g. to compare runs. (default: don't)",
+    )
+    parser.add_argument(
+        "--stats-top",
+        type=int,
+        metavar="N",
+        default=DEFAULT_TOP_N,
+        help=f"How many of the slowest paths to keep. (default: {DEFAULT_TOP_N})",
+    )
+    parser.add_argument(
+        "--no-progress",
+        dest="show_progress",
+        action="store_false",
+        help="Don't show live progress on stderr. (default: show it, if stderr is a terminal)",
+    )
+
+
+def report(stats, args):
+    """
+    Prints and/or writes the statistics, as requested by the arguments from add_arguments().
+    """
+    if args.print_stats:
+        stats.print_summary()
+    if args.stats_json is not None:
+        stats.write_json(args.stats_json)
@@ -1,112 +1,701 @@
 #!/usr/bin/env python3
 
-from collections import defaultdict
 import argparse
+import bisect
+import concurrent.futures
+import contextlib
+import expectation_io
+import expectation_record
+import expectation_store
+import heapq
+import instrumentation
+import itertools
 import json
-import pathlib
+import os
+import pickle
 import sys
+import tempfile
+import zlib
 
 
-def update_or_equal(dict_, key, new_value):
-    if key in dict_:
-        old_value = dict_[key]
-        if old_value == new_value:
-            return 0
-        old_without_mtime = dict(old_value)
-        del old_without_mtime["mtime"]
-        new_without_mtime = dict(new_value)
-        del new_without_mtime["mtime"]
-        if old_without_mtime != new_without_mtime:
-            print(f"ERROR: CONFLICT for key {key}:\n{old_value}\n{new_value}")
-            return 1
-        # At this point, the conflict is only about mtime. This is actually quite common, so we want to report it only once, each.
-        if old_value["mtime"] is None:
-            # Already reported, nothing to do.
-            return 0
-        print(
-            f"Warning: Conflicting mtime for {key} (e.g. {old_value['mtime']} vs. {new_value['mtime']})",
-            file=sys.stderr,
-        )
-        old_value['mtime'] = None
-        # No need to update dict_, since it still contains old_value by reference.
+# With --jobs, the subtrees this many levels deep are split between the processes. Much less than
+# that, and /usr alone would be most of the work; much more, and the spine above them grows.
+SHARD_DEPTH = 4
+# With --jobs, the sorted runs of each shard are pickled in batches of this many items, which is
+# faster than pickling them one by one.
+RUN_BATCH_SIZE = 1024
+# These keys are bookkeeping, and don't describe the file itself:
+# "chunks" only refine "sha256", which is compared anyway; it may be missing if a .deb was converted without --chunk-threshold.
+NON_CONFLICTING_KEYS = ["mtime", "children", "packages", "chunks", "variants"]
+# These keys are never part of a package's variant (see merge_equal).
+NON_VARIANT_KEYS = ["type", "name", "children", "packages", "chunks", "variants"]
+
+
+def without_non_conflicting_keys(value):
+    return {k: v for k, v in value.items() if k not in NON_CONFLICTING_KEYS}
+
+
+def package_variant(row, value):
+    """
+    Returns what 'value', as contributed by a single package, has differently from the merged 'row'.
+    """
+    variant = {k: v for k, v in value.items() if k not in NON_VARIANT_KEYS and row.get(k) != v}
+    if "sha256" in variant and "chunks" in value:
+        variant["chunks"] = value["chunks"]
+    return variant
+
+
+def package_values(expectation):
+    """
+    Yields (package, value) for each package of a merged expectation, where 'value' is the
+    expectation as that package alone contributed it.
+    """
+    variants = expectation.get("variants", {})
+    for package in expectation.get("packages", []):
+        value = {k: v for k, v in expectation.items() if k != "variants"}
+        value.update(variants.get(package, {}))
+        value["packages"] = [package]
+        yield package, value
+
+
+def merge_equal(key, old_value, new_value, log=print):
+    """
+    Merges new_value into old_value, which describe the same path. Returns the number of errors.
+    Messages are printed with 'log', which takes the same arguments as print.
+
+    The merged value keeps the attributes of old_value. Whatever a package contributed differently
+    (the mtime, once the mtimes conflict, or everything that conflicts) is kept in the 'variants'
+    of the merged value, which map each such package to what's different. That way, the value can
+    be rebuilt once some of the packages are gone (see merge_packages).
+    """
+    old_packages = old_value.get("packages", [])
+    new_values = []
+    if "packages" in old_value or "packages" in new_value:
+        # The list is already sorted. Shared directories like /usr have thousands of packages,
+        # so building and sorting a set each time would make merging quadratic.
+        packages = list(old_packages)
+        for package, value in package_values(new_value):
+            index = bisect.bisect_left(packages, package)
+            if index == len(packages) or packages[index] != package:
+                packages.insert(index, package)
+                new_values.append((package, value))
+        old_value["packages"] = packages
+    variants = old_value.get("variants", {})
+    errors = 0
+    if without_non_conflicting_keys(old_value) != without_non_conflicting_keys(new_value):
+        log(f"ERROR: CONFLICT for key {key}:\n{old_value}\n{new_value}")
+        errors = 1
     else:
-        dict_[key] = new_value
-    return 0
+        if "chunks" not in old_value and "chunks" in new_value:
+            old_value["chunks"] = new_value["chunks"]
+        # If the mtime conflicts, that's actually quite common, so we want to report it only once, each.
+        # If it's None, it was already reported.
+        if old_value["mtime"] != new_value["mtime"] and old_value["mtime"] is not None:
+            log(
+                f"Warning: Conflicting mtime for {key} (e.g. {old_value['mtime']} vs. {new_value['mtime']})",
+                file=sys.stderr,
+            )
+            # Until now, all packages without an mtime of their own had this one.
+            for package in old_packages:
+                variants[package] = {"mtime": old_value["mtime"], **variants.get(package, {})}
+            old_value["mtime"] = None
+    for package, value in new_values:
+        variant = package_variant(old_value, value)
+        if variant:
+            variants[package] = variant
+    if variants:
+        old_value["variants"] = variants
+    return errors
 
 
-def do_merge(sources):
-    # Step 1: Resolve potential conflicts and prepare data:
-    path_to_filedict = dict()
-    path_to_all_children = defaultdict(set)
-    # TODO: Stream instead of doing multi-pass.
-    # Also, memory-efficiency in general.
+def merge_packages(key, expectation, packages, log=print):
+    """
+    Returns the merged expectation as if only 'packages' (some of its own) had contributed to it,
+    and the number of errors.
+    """
+    values = [value for package, value in package_values(expectation) if package in packages]
+    merged = values[0]
     errors = 0
-    for source_index, source in enumerate(sources):
-        for file_expectation in source:
-            # Wtf, black?!
-            assert (
-                file_expectation["type"] == "file"
-            ), f"Entry in source #{i} (0-indexed) does not have type=file. Maybe target and sources mixed up?"
-            name = file_expectation["name"]
-            path = pathlib.Path(name)
-            errors += update_or_equal(path_to_filedict, path.as_posix(), file_expectation)
-            if name != ".":
-                path_to_all_children[path.parent.as_posix()].add(path.name)
-
-    # Step 2: Generate new expectations
-    # Specifically, we now expect that each directory *only* contains the mentioned files.
-    for parent, children in path_to_all_children.items():
-        assert parent in path_to_filedict
-        parent_entry = path_to_filedict[parent]
-        assert parent_entry["filetype"] == "dir"
-        assert parent_entry["children"] == None
-        children_list = list(children)
-        children_list.sort()
-        parent_entry["children"] = children_list
-
-    # Sanity check that we caught all dirs
-    for entry in path_to_filedict.values():
-        if entry["filetype"] != "dir":
+    for value in values[1:]:
+        errors += merge_equal(key, merged, value, log)
+    return merged, errors
+
+
+class UnsortedSourceError(ValueError):
+    pass
+
+
+def decorate_source(source_index, source):
+    source = iter(source)
+    head = list(itertools.islice(source, 2))
+    if len(head) == 2 and is_ancestor(head[0]["name"], head[1]["name"]):
+        # Written by an older deb2fsexpect.py, in the order of the .deb, where each directory comes
+        # before its contents. A single .deb easily fits into memory, so just sort it here.
+        source = sorted(itertools.chain(head, source), key=expectation_io.expectation_sort_key)
+    else:
+        source = itertools.chain(head, source)
+    last_sort_key = None
+    for file_expectation in source:
+        # Wtf, black?!
+        assert (
+            file_expectation["type"] == "file"
+        ), f"Entry in source #{source_index} (0-indexed) does not have type=file. Maybe target and sources mixed up?"
+        parts = expectation_io.name_to_parts(file_expectation["name"])
+        sort_key = expectation_io.parts_sort_key(parts)
+        if last_sort_key is not None and sort_key < last_sort_key:
+            raise UnsortedSourceError(
+                f"Source #{source_index} (0-indexed) is not sorted at {file_expectation['name']}. Please regenerate it with the current deb2fsexpect.py."
+            )
+        last_sort_key = sort_key
+        yield sort_key, parts, file_expectation
+
+
+def is_ancestor(name, other_name):
+    parts = expectation_io.name_to_parts(name)
+    other_parts = expectation_io.name_to_parts(other_name)
+    return len(parts) < len(other_parts) and other_parts[: len(parts)] == parts
+
+
+class MessageLog:
+    """
+    Collects the messages of merge_equal instead of printing them, along with the sort key of
+    the path they are about, so that the messages of all shards can be printed in the same
+    order as without --jobs.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.sort_key = None
+
+    def print(self, text, file=sys.stdout):
+        self.messages.append((self.sort_key, file is sys.stderr, text))
+
+
+def print_messages(messages):
+    for _sort_key, is_stderr, text in sorted(messages, key=lambda message: message[0]):
+        print(text, file=sys.stderr if is_stderr else sys.stdout)
+
+
+def decorate_sources(sources, first_index=0):
+    """
+    Returns the items (sort_key, parts, expectation) of all sources, sorted by sort_key. Items with
+    the same sort key come in the order of their sources, which are numbered from first_index on.
+    """
+    decorated_sources = [decorate_source(i, source) for i, source in enumerate(sources, first_index)]
+    return heapq.merge(*decorated_sources, key=lambda item: item[0])
+
+
+def do_merge(sources, emit):
+    """
+    Merges the sources, each of which must be an iterable of expectations sorted by
+    expectation_io.expectation_sort_key, and calls 'emit' with each resulting expectation,
+    again in that order. Returns the number of errors.
+
+    Only the currently open directories are kept in memory, so the memory usage depends on
+    the depth of the tree and the number of sources, not on the total number of files.
+    """
+    return merge_decorated(decorate_sources(sources), emit)
+
+
+def merge_decorated(merged, emit, log=None, select=None, detached_children=None):
+    """
+    Does the actual work of do_merge, given the sorted items of all sources (see decorate_sources).
+
+    If 'log' is a MessageLog, messages are collected there instead of being printed.
+    If 'select' is given, 'merged' must consist of whole subtrees for which select(parts) is true;
+    the children of their (unselected) parent directories are added to the dict
+    'detached_children', which maps parts to a set of names.
+    """
+    errors = 0
+    # Stack of (parts, set_of_children) of directories whose entry has not been reached yet.
+    # Each entry on the stack is a proper prefix of the next one.
+    open_dirs = []
+
+    def detach(parts):
+        while open_dirs and open_dirs[-1][0] != parts[: len(open_dirs[-1][0])]:
+            if select is None or select(open_dirs[-1][0]):
+                # The directory entry should have come between its contents and this entry.
+                raise AssertionError(f"Missing directory entry for {expectation_io.parts_to_key(open_dirs[-1][0])}")
+            dir_parts, children = open_dirs.pop()
+            detached_children.setdefault(dir_parts, set()).update(children)
+
+    def finish(parts, entry):
+        detach(parts)
+        if open_dirs and open_dirs[-1][0] == parts:
+            # Specifically, we now expect that each directory *only* contains the mentioned files.
+            _, children = open_dirs.pop()
+            assert entry["filetype"] == "dir", entry
+            assert entry["children"] is None, entry
+            children_list = list(children)
+            children_list.sort()
+            entry["children"] = children_list
+        if parts:
+            parent = parts[:-1]
+            if open_dirs and open_dirs[-1][0] == parent:
+                open_dirs[-1][1].add(parts[-1])
+            else:
+                open_dirs.append((parent, {parts[-1]}))
+        emit(entry)
+
+    pending_parts = None
+    pending_entry = None
+    for sort_key, parts, file_expectation in merged:
+        if pending_entry is not None and parts == pending_parts:
+            if log is not None:
+                log.sort_key = sort_key
+            errors += merge_equal(
+                expectation_io.parts_to_key(parts),
+                pending_entry,
+                file_expectation,
+                print if log is None else log.print,
+            )
             continue
-        if "children" not in entry:
-            print(f"Not checking children of {entry.name}", file=sys.stderr)
+        if pending_entry is not None:
+            finish(pending_parts, pending_entry)
+        pending_parts = parts
+        pending_entry = file_expectation
+    if pending_entry is not None:
+        finish(pending_parts, pending_entry)
+    # Nothing but the root is a prefix of (), so this detaches whatever is left.
+    detach(())
+    if open_dirs:
+        raise AssertionError(f"Missing directory entry for {expectation_io.parts_to_key(open_dirs[-1][0])}")
+
+    return errors
+
 
-    # Step 3: Emit deduplicated, rearranged data
-    expectations = list(path_to_filedict.values())
-    del path_to_filedict  # Early gc, just in case it helps
-    expectations.sort(key=lambda e: e["name"])
+def shard_of(parts, shards):
+    """
+    Returns the shard (between 0 and shards - 1) of a path, or None for paths of the spine: those
+    with fewer than SHARD_DEPTH components. Each subtree at SHARD_DEPTH belongs to a single shard.
+    """
+    if len(parts) < SHARD_DEPTH:
+        return None
+    return zlib.crc32("/".join(parts[:SHARD_DEPTH]).encode("utf-8", "surrogateescape")) % shards
 
-    return expectations, errors
+
+class ShardWriter:
+    """
+    Writes the output of one shard to a file, as pickled records of (sort_key, parts, expectation)
+    for each path of the spine, whose children may still change, and of (sort_key, None, (count,
+    segment)) for each SHARD_DEPTH-deep subtree. A segment is either the JSON text of all its
+    expectations (if 'encode' is set), so that it can be copied to the result as is, or a list of them.
+    """
+
+    def __init__(self, fp, encode):
+        self.fp = fp
+        self.encode = encode
+        self.segment_parts = None
+        self.segment_sort_key = None
+        self.segment = []
+
+    def write(self, expectation):
+        parts = expectation_io.name_to_parts(expectation["name"])
+        if len(parts) < SHARD_DEPTH:
+            pickle.dump((expectation_io.parts_sort_key(parts), parts, expectation), self.fp)
+            return
+        if parts[:SHARD_DEPTH] != self.segment_parts:
+            # Each subtree is contiguous, and it starts with the first expectation in it.
+            self.close()
+            self.segment_parts = parts[:SHARD_DEPTH]
+            self.segment_sort_key = expectation_io.parts_sort_key(parts)
+        self.segment.append(json.dumps(expectation) if self.encode else expectation)
+
+    def close(self):
+        if self.segment:
+            segment = ", ".join(self.segment) if self.encode else self.segment
+            pickle.dump((self.segment_sort_key, None, (len(self.segment), segment)), self.fp)
+        self.segment = []
+
+
+def source_groups(source_filenames, count):
+    """
+    Splits the sources into at most 'count' consecutive groups of roughly the same total size.
+    """
+    sizes = [os.path.getsize(source_filename) for source_filename in source_filenames]
+    total_size = sum(sizes)
+    groups = []
+    group_start = 0
+    size_so_far = 0
+    for index, size in enumerate(sizes):
+        size_so_far += size
+        if len(groups) < count - 1 and size_so_far * count >= total_size * (len(groups) + 1):
+            groups.append(source_filenames[group_start : index + 1])
+            group_start = index + 1
+    if group_start < len(source_filenames):
+        groups.append(source_filenames[group_start:])
+    return groups
+
+
+def split_sources(source_filenames, first_index, shards, run_filenames, stats_top):
+    """
+    Runs in a worker process: Reads a group of sources, and writes their items (see
+    decorate_sources) to one file per shard, as a sorted run of pickled batches of expectations.
+    The first file gets the spine, and file i + 1 shard i.
+    Returns the statistics.
+    """
+    stats = instrumentation.Stats("merge_expectations", stats_top)
+    _sources, timed_sources = open_timed_sources(stats, source_filenames)
+    with contextlib.ExitStack() as stack:
+        run_files = [stack.enter_context(open(run_filename, "wb")) for run_filename in run_filenames]
+        batches = [[] for _ in run_files]
+        for item in decorate_sources(timed_sources, first_index):
+            shard = shard_of(item[1], shards)
+            index = 0 if shard is None else shard + 1
+            # The sort key and parts are quicker to compute again than to pickle.
+            batches[index].append(item[2])
+            if len(batches[index]) >= RUN_BATCH_SIZE:
+                with stats.phase("split_write"):
+                    pickle.dump(batches[index], run_files[index])
+                batches[index] = []
+        with stats.phase("split_write"):
+            for batch, run_file in zip(batches, run_files):
+                if batch:
+                    pickle.dump(batch, run_file)
+    return stats.to_dict()
+
+
+def read_run(filename):
+    for batch in read_pickled(filename):
+        for expectation in batch:
+            parts = expectation_io.name_to_parts(expectation["name"])
+            yield expectation_io.parts_sort_key(parts), parts, expectation
+
+
+def merge_shard(run_filenames, shard, shards, output_filename, encode, stats_top):
+    """
+    Runs in a worker process: Merges the sorted runs of one shard (or the spine, if shard is None)
+    that split_sources wrote for each group of sources, and writes the result to output_filename
+    with a ShardWriter.
+    Returns the number of errors, the collected messages, the detached children, and the statistics.
+    """
+    stats = instrumentation.Stats("merge_expectations", stats_top)
+    log = MessageLog()
+    detached_children = dict()
+    # The groups are in the order of their sources, so equal paths are merged in the same order as by do_merge.
+    runs = [stats.timed(read_run(run_filename), "read_runs") for run_filename in run_filenames]
+    with open(output_filename, "wb") as fp:
+        writer = ShardWriter(fp, encode)
+
+        def emit(expectation):
+            with stats.phase("shard_write"):
+                writer.write(expectation)
+
+        errors = merge_decorated(
+            heapq.merge(*runs, key=lambda item: item[0]),
+            emit,
+            log,
+            lambda parts: shard_of(parts, shards) == shard,
+            detached_children,
+        )
+        with stats.phase("shard_write"):
+            writer.close()
+    return errors, log.messages, detached_children, stats.to_dict()
+
+
+def read_pickled(filename):
+    with open(filename, "rb") as fp:
+        while True:
+            try:
+                yield pickle.load(fp)
+            except EOFError:
+                return
+
+
+def do_merge_parallel(source_filenames, emit, emit_segment, encode, jobs, stats):
+    """
+    Like do_merge, but in 'jobs' processes. First, each of them reads a group of sources, and
+    splits their expectations into shards: Each SHARD_DEPTH-deep subtree belongs to one of 'jobs'
+    shards, and the rest (the directories above those subtrees, and the files among them) to the
+    spine. Then each shard and the spine is merged on its own, and the children found by all
+    shards are added to the spine at the end. Finally, the shards are concatenated in order.
+
+    'emit' is called for each expectation of the spine, and emit_segment(count, segment) for each
+    segment (see ShardWriter), whose expectations are encoded as JSON if 'encode' is set.
+    All messages are printed in the same order as by do_merge, but only once all shards are done.
+    Returns the number of errors.
+    """
+    errors = 0
+    messages = []
+    detached_children = dict()
+    groups = source_groups(source_filenames, jobs)
+    shards = [None] + list(range(jobs))
+    with tempfile.TemporaryDirectory(prefix="merge_expectations.") as temp_dir:
+        run_filenames = [
+            [os.path.join(temp_dir, f"run{group_index}.{shard_index}.pickle") for shard_index in range(len(shards))]
+            for group_index in range(len(groups))
+        ]
+        shard_filenames = [os.path.join(temp_dir, f"shard{index}.pickle") for index in range(len(shards))]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = []
+            first_index = 0
+            for group, group_run_filenames in zip(groups, run_filenames):
+                futures.append(
+                    executor.submit(split_sources, group, first_index, jobs, group_run_filenames, stats.top_n)
+                )
+                first_index += len(group)
+            for future in futures:
+                stats.merge(future.result())
+            futures = [
+                executor.submit(
+                    merge_shard,
+                    [group_run_filenames[shard_index] for group_run_filenames in run_filenames],
+                    shard,
+                    jobs,
+                    shard_filename,
+                    encode,
+                    stats.top_n,
+                )
+                for shard_index, (shard, shard_filename) in enumerate(zip(shards, shard_filenames))
+            ]
+            for future in futures:
+                shard_errors, shard_messages, shard_children, shard_stats = future.result()
+                errors += shard_errors
+                messages.extend(shard_messages)
+                for parts, children in shard_children.items():
+                    detached_children.setdefault(parts, set()).update(children)
+                stats.merge(shard_stats)
+        print_messages(messages)
+        # The shards don't overlap, and each of them is sorted already.
+        merged = heapq.merge(*[read_pickled(filename) for filename in shard_filenames], key=lambda item: item[0])
+        for _sort_key, parts, item in stats.timed(merged, "read_shards"):
+            if parts is None:
+                emit_segment(*item)
+                continue
+            children = detached_children.pop(parts, None)
+            if children is not None:
+                # Just like in do_merge, only directories can have contents.
+                assert item["filetype"] == "dir", item
+                children.update(item["children"] or [])
+                item["children"] = sorted(children)
+            emit(item)
+    if detached_children:
+        parts = min(detached_children, key=expectation_io.parts_sort_key)
+        raise AssertionError(f"Missing directory entry for {expectation_io.parts_to_key(parts)}")
+    return errors
+
+
+def sources_fraction(sources):
+    """
+    Returns a callable that tells how much of the sources has been read, or None if there's no way to tell.
+    """
+    json_sources = [source for source in sources if isinstance(source, expectation_io.JsonExpectations)]
+    total_size = sum(source.size for source in json_sources)
+    if len(json_sources) < len(sources) or not total_size:
+        return None
+    return lambda: sum(source.bytes_read() for source in json_sources) / total_size
+
+
+def open_timed_sources(stats, source_filenames):
+    """
+    Returns the opened sources, and the same sources wrapped to record how long reading each of them takes.
+    """
+    sources = [expectation_io.open_expectations(source_filename) for source_filename in source_filenames]
+    timed_sources = [
+        stats.timed(source, "read", name=source_filename) for source, source_filename in zip(sources, source_filenames)
+    ]
+    return sources, timed_sources
 
 
 def run(args):
-    sources = []
-    for source_filename in args.source_filenames:
-        with open(source_filename, "r") as fp:
-            sources.append(json.load(fp))
-    result, errors = do_merge(sources)
-    with open(args.result_filename, "w") as fp:
-        json.dump(result, fp)
+    stats = instrumentation.Stats("merge_expectations", args.stats_top)
+    sources, timed_sources = open_timed_sources(stats, args.source_filenames)
+    progress = instrumentation.Progress(stats, "expectations", sources_fraction(sources), enabled=args.show_progress)
+    writer = expectation_io.create_expectation_writer(args.result_filename)
+
+    def emit(expectation):
+        with stats.phase("write"):
+            writer.write(expectation)
+        progress.update()
+
+    def emit_segment(count, segment):
+        with stats.phase("write"):
+            if isinstance(segment, str):
+                writer.write_encoded(segment, count)
+            else:
+                for expectation in segment:
+                    writer.write(expectation)
+        progress.update(count)
+
+    try:
+        if args.jobs > 1:
+            encode = isinstance(writer, expectation_io.JsonFileWriter)
+            errors = do_merge_parallel(args.source_filenames, emit, emit_segment, encode, args.jobs, stats)
+        else:
+            errors = do_merge(timed_sources, emit)
+    except UnsortedSourceError as e:
+        print(f"{e} Output file is incomplete.", file=sys.stderr)
+        exit(1)
+    with stats.phase("write"):
+        writer.close()
+    progress.finish()
+    instrumentation.report(stats, args)
+    if errors:
+        print(f"Encountered {errors} errors. Output file is usable, but will cause false positives.")
+        exit(1)
+
+
+def do_update(store, sources, removed_packages):
+    """
+    Updates a merged store in place: First removes all contributions of 'removed_packages' and of
+    all packages that appear in 'sources', then merges in the sources. Only the touched paths are
+    checked for conflicts, and only directories whose contents changed get their children recomputed.
+    Returns the number of errors.
+    """
+    errors = 0
+    replaced_packages = set(removed_packages)
+    # All of them are kept until the end, so keep them small.
+    new_expectations = []
+    errors += do_merge(sources, lambda expectation: new_expectations.append(expectation_record.compact(expectation)))
+    for expectation in new_expectations:
+        if not expectation.get("packages"):
+            raise ValueError(
+                f"Expectation for {expectation['name']} doesn't say which package it came from. Please regenerate the sources with the current deb2fsexpect.py."
+            )
+        replaced_packages.update(expectation["packages"])
+
+    # Step 1: Remove all old contributions of the replaced packages.
+    dirty_dirs = set()
+    seqs = set()
+    for package in replaced_packages:
+        seqs.update(store.package_seqs(package))
+    for seq in sorted(seqs):
+        expectation = store.expectation(seq)
+        remaining_packages = [p for p in expectation["packages"] if p not in replaced_packages]
+        parts = expectation_io.name_to_parts(expectation["name"])
+        if remaining_packages and "variants" in expectation:
+            # The stored attributes may be those of a replaced package, so start over from what the remaining ones contributed.
+            remaining_expectation, remaining_errors = merge_packages(
+                expectation_io.parts_to_key(parts), expectation, remaining_packages
+            )
+            errors += remaining_errors
+            store.replace(seq, remaining_expectation)
+            continue
+        if remaining_packages:
+            # All of them contributed exactly the stored attributes.
+            store.set_packages(seq, remaining_packages)
+            continue
+        store.delete(seq)
+        if parts:
+            dirty_dirs.add(parts[:-1])
+
+    # Step 2: Merge in the new expectations.
+    for expectation in new_expectations:
+        parts = expectation_io.name_to_parts(expectation["name"])
+        existing = store.find(parts)
+        if existing:
+            seq, old_expectation = existing[0]
+            errors += merge_equal(expectation_io.parts_to_key(parts), old_expectation, expectation)
+            store.replace(seq, old_expectation)
+            continue
+        if expectation["filetype"] == "dir":
+            dirty_dirs.add(parts)
+        expectation["children"] = None
+        store.write(expectation)
+        if parts:
+            dirty_dirs.add(parts[:-1])
+
+    # Step 3: Recompute the children of all directories whose contents changed.
+    for parts in sorted(dirty_dirs):
+        children = store.child_names(parts)
+        existing = store.find(parts)
+        if not existing:
+            if children:
+                print(
+                    f"ERROR: Directory {expectation_io.parts_to_key(parts)} is no longer expected, but its children {children} are",
+                )
+                errors += 1
+            continue
+        seq, expectation = existing[0]
+        if expectation["filetype"] != "dir":
+            continue
+        # Just like do_merge, empty directories don't get a list of children.
+        store.set_children(seq, children or None)
+
+    print(
+        f"Replaced {len(replaced_packages)} packages: {len(seqs)} old and {len(new_expectations)} new expectations, {len(dirty_dirs)} directories updated.",
+        file=sys.stderr,
+    )
+    return errors
+
+
+def run_update(args):
+    if not expectation_store.is_store(args.total_filename):
+        print(
+            f"update only works on the compact format. Use convert_expectations.py to convert {args.total_filename} first.",
+            file=sys.stderr,
+        )
+        exit(1)
+    stats = instrumentation.Stats("merge_expectations update", args.stats_top)
+    store = expectation_store.ExpectationStoreWriter(args.total_filename, edit=True)
+    _sources, timed_sources = open_timed_sources(stats, args.source_filenames)
+    try:
+        with stats.phase("update"):
+            errors = do_update(store, timed_sources, args.remove)
+    except UnsortedSourceError as e:
+        print(f"{e} {args.total_filename} was not changed.", file=sys.stderr)
+        exit(1)
+    with stats.phase("write"):
+        store.close()
+    instrumentation.report(stats, args)
     if errors:
         print(f"Encountered {errors} errors. Output file is usable, but will cause false positives.")
         exit(1)
 
 
+def build_update_parser():
+    parser = argparse.ArgumentParser(
+        prog="merge_expectations.py update",
+        description="Replaces the contributions of some packages in an existing merged result, without merging everything again.",
+    )
+    parser.add_argument(
+        "total_filename",
+        metavar=f"RESULT.total{expectation_io.STORE_SUFFIX}",
+    )
+    parser.add_argument(
+        "source_filenames",
+        metavar="NEW_SOURCES.deb.json",
+        nargs="*",
+        help="New versions of packages. All old expectations of these packages are replaced.",
+    )
+    parser.add_argument(
+        "--remove",
+        metavar="PACKAGE:ARCH",
+        action="append",
+        default=[],
+        help="Remove all expectations of this package, e.g. because it was purged. Can be specified multiple times.",
+    )
+    instrumentation.add_arguments(parser)
+    return parser
+
+
 def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "result_filename",
         metavar="RESULT.total.json",
+        help=f"Output file. If it ends in '{expectation_io.STORE_SUFFIX}', the compact indexed format is used instead of JSON.",
     )
     parser.add_argument(
         "source_filenames",
         metavar="TWO_OR_MORE_SOURCES.deb.json",
         nargs="+"
     )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help=f"Merge in this many processes, which split the sources by the subtrees {SHARD_DEPTH} levels deep (like usr/share/doc/foo) into temporary files, and then merge a share of those subtrees each. Pays off with many sources and cores. (default: 1, merge in this process)",
+    )
+    instrumentation.add_arguments(parser)
     return parser
 
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["update"]:
+        run_update(build_update_parser().parse_args(sys.argv[2:]))
+        exit(0)
     args = build_parser().parse_args()
     if len(args.source_filenames) == 1:
         print(f"Only one source file given. This does not usually make sense, aborting.", file=sys.stderr)
@@ -0,0 +1,139 @@
+"""
+Sinks for the reports of check_expect.py. A sink gets each report as soon as it is found, along
+with the expectation it is about (or None, e.g. for unexpected hardlinks), and is closed at the end.
+
+- JsonLinesSink writes each report as one line of JSON.
+- SummarySink counts the reports by finding (report key), by top-level directory and by package.
+- LatestReportSink keeps the latest report for each path, which --watch needs to tell what's new.
+- TeeSink passes each report on to several other sinks.
+
+Only LatestReportSink (and SummarySink with keep_names) keeps anything per report, so otherwise
+memory usage doesn't grow with the number of findings.
+"""
+
+import collections
+import expectation_io
+import json
+import sys
+import threading
+
+
+DEFAULT_TOP_N = 10
+# Report keys that say which path a report is about, rather than what was found.
+IDENTIFYING_KEYS = ["name", "root"]
+UNKNOWN_PACKAGE = "(unknown)"
+OTHERS = "(others)"
+# Shared by all sinks, since they usually all write to stdout, e.g. one for each --destdir root.
+OUTPUT_LOCK = threading.Lock()
+
+
+class JsonLinesSink:
+    def __init__(self, fp=None, root=None, flush=False):
+        self.fp = sys.stdout if fp is None else fp
+        self.root = root
+        self.flush = flush
+
+    def write(self, report, expectation=None):
+        if self.root is not None:
+            # The name is relative to the root, so tell the roots apart.
+            report = dict(root=self.root, **report)
+        line = json.dumps(report)
+        with OUTPUT_LOCK:
+            print(line, file=self.fp, flush=self.flush)
+
+    def close(self):
+        with OUTPUT_LOCK:
+            self.fp.flush()
+
+
+def most_common(counter, top_n):
+    """
+    Returns the top_n most common entries as a dict, plus the sum of all others.
+    """
+    top = dict(counter.most_common(top_n))
+    others = sum(counter.values()) - sum(top.values())
+    if others:
+        top[OTHERS] = others
+    return top
+
+
+class SummarySink:
+    def __init__(self, top_n=DEFAULT_TOP_N, keep_names=False):
+        self.top_n = top_n
+        self.findings = 0
+        self.keys = collections.Counter()
+        self.directories = collections.Counter()
+        self.packages = collections.Counter()
+        # Only needed to compare several roots; this grows with the number of findings.
+        self.names = set() if keep_names else None
+        self.lock = threading.Lock()
+
+    def write(self, report, expectation=None):
+        parts = expectation_io.name_to_parts(report["name"])
+        directory = "/" + parts[0] if parts else "/"
+        packages = None if expectation is None else expectation.get("packages")
+        with self.lock:
+            self.findings += 1
+            self.keys.update(key for key in report if key not in IDENTIFYING_KEYS)
+            self.directories[directory] += 1
+            self.packages.update(packages or [UNKNOWN_PACKAGE])
+            if self.names is not None:
+                self.names.add(report["name"])
+
+    def merge(self, other):
+        with self.lock:
+            self.findings += other.findings
+            self.keys.update(other.keys)
+            self.directories.update(other.directories)
+            self.packages.update(other.packages)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "findings": self.findings,
+                "by_finding": dict(self.keys.most_common()),
+                "by_directory": most_common(self.directories, self.top_n),
+                "by_package": most_common(self.packages, self.top_n),
+            }
+
+    def print_summary(self, file=sys.stderr):
+        data = self.to_dict()
+        print(f"Summary: {data['findings']} findings", file=file)
+        for title, key in [("finding", "by_finding"), ("directory", "by_directory"), ("package", "by_package")]:
+            if data[key]:
+                details = ", ".join(f"{name}: {count}" for name, count in data[key].items())
+                print(f"  By {title}: {details}", file=file)
+
+    def write_json(self, filename):
+        with open(filename, "w") as fp:
+            json.dump(self.to_dict(), fp, indent=1)
+
+    def close(self):
+        pass
+
+
+class LatestReportSink:
+    def __init__(self):
+        # Maps the name of each path with findings to its latest report.
+        self.reports = dict()
+
+    def write(self, report, expectation=None):
+        # Reports without an expectation, like unexpected hardlinks, can't be checked again on their own.
+        if expectation is not None:
+            self.reports[report["name"]] = report
+
+    def close(self):
+        pass
+
+
+class TeeSink:
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def write(self, report, expectation=None):
+        for sink in self.sinks:
+            sink.write(report, expectation)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()